@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio flavour of libkak and langserver. Python 3 only.
+
+Handlers of commands, hooks and onclient calls can be coroutine
+functions, pipe can be awaited and Langserver has a request coroutine.
+Calls from Kakoune and responses from language servers are handed to
+an event loop instead of each getting a thread of its own.
+
+The loop is the one running when a Remote or Langserver is created, or
+else one that is started in a background thread.
+"""
+
+import asyncio
+import threading
+import langserver
+import libkak
+
+
+class Remote(libkak.Remote):
+    """
+    A libkak.Remote which calls its handler on an event loop.
+
+    Handlers may be coroutine functions, and the pipe they get is a
+    coroutine function. Calling a one-shot Remote returns an awaitable.
+    """
+
+    def __init__(self, session):
+        super().__init__(session)
+        self.loop = get_loop()
+        self.call = self.loop.create_future()
+        self.ret = self._ret
+
+    def deliver(self, line):
+        if self.serving:
+            self.loop.call_soon_threadsafe(self._spawn, line)
+        else:
+            self.loop.call_soon_threadsafe(self._set_call, line)
+
+    def _set_call(self, line):
+        if not self.call.done():
+            self.call.set_result(line)
+
+    def _spawn(self, line):
+        asyncio.ensure_future(self._handle(line), loop=self.loop)
+
+    async def _handle(self, line):
+        result = self.handle(line)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def _finish(self, result, check):
+        if not asyncio.iscoroutine(result):
+            return super()._finish(result, check)
+
+        async def finish():
+            value = await result
+            check()
+            return value
+        return finish()
+
+    async def _ret(self):
+        try:
+            line = await self.call
+        finally:
+            self.unregister()
+        if line == '_q':
+            raise RuntimeError('fifo demands quit')
+        return await self._handle(line)
+
+    def _pipe_for(self, client):
+        def _pipe(msg, sync=False):
+            return pipe(self.session, msg, client, sync)
+        return _pipe
+
+
+def command(session, *args, **kwargs):
+    """
+    Like libkak.Remote.command, with the handler called on an event loop.
+    """
+    return libkak.Remote.command(Remote(session), *args, **kwargs)
+
+
+def hook(session, *args, **kwargs):
+    """
+    Like libkak.Remote.hook, with the handler called on an event loop.
+    """
+    return libkak.Remote.hook(Remote(session), *args, **kwargs)
+
+
+def onclient(session, client):
+    """
+    Like libkak.Remote.onclient, but calling it returns an awaitable.
+    """
+    return libkak.Remote.onclient(Remote(session), client)
+
+
+async def pipe(session, msg, client=None, sync=False):
+    """
+    Send commands to a running Kakoune process.
+
+    If sync is true, this returns after the commands have been executed,
+    without blocking a thread while waiting.
+    """
+    if not sync:
+        libkak.pipe(session, msg, client)
+        return
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def set_done():
+        loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+    libkak._pipe(session, msg, client, set_done)
+    await done
+
+
+class Langserver(langserver.Langserver):
+    """
+    A Langserver with a coroutine for making requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.loop = get_loop()
+        super().__init__(*args, **kwargs)
+
+    async def request(self, method, params):
+        """
+        Make a request and return the response message.
+        """
+        result = self.loop.create_future()
+
+        def cb(msg):
+            self.loop.call_soon_threadsafe(result.set_result, msg)
+        self.call(method, params)(cb)
+        return await result
+
+
+def get_loop(_background=[], _lock=threading.Lock()):
+    """
+    The running event loop, or else a loop running in a background thread.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    with _lock:
+        if not _background:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever)
+            thread.daemon = True
+            thread.start()
+            _background.append(loop)
+        return _background[0]
+
+
+def run(coro):
+    """
+    Run a coroutine to completion on the background loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def _test_async_remote():
+    u"""
+    >>> kak = libkak.headless()
+    >>> async def main():
+    ...     await pipe(kak.pid, 'exec iapa<esc>\\\\%H', 'unnamed0', sync=True)
+    ...     async def selection(selection):
+    ...         return selection
+    ...     print(await onclient(kak.pid, 'unnamed0')(selection))
+    ...     q = asyncio.Queue()
+    ...     @command(kak.pid, sync_setup=True)
+    ...     async def put_selection(selection, pipe):
+    ...         await pipe('echo', sync=True)
+    ...         await q.put(selection)
+    ...     await pipe(kak.pid, 'put-selection', 'unnamed0')
+    ...     print(await q.get())
+    >>> run(main())
+    apa
+    apa
+    >>> libkak.pipe(kak.pid, 'quit!', 'unnamed0')
+    >>> kak.wait()
+    0
+    >>> libkak._fifo_cleanup()
+    """
+    pass
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,28 +2,63 @@
 
 from __future__ import print_function
 from collections import defaultdict, OrderedDict
-from six.moves.queue import Queue
+from six.moves.queue import Queue, Empty
 from subprocess import Popen, PIPE
-from threading import Thread
+from threading import Thread, Lock, Timer, Event
 import pprint
 import itertools as it
 import json
+import logging
 import os
 import six
 import sys
 import tempfile
+import time
 import utils
 import functools
 import re
 
 
+log = logging.getLogger('langserver')
+
+
+MethodNotFound = -32601
+InternalError = -32603
+RequestCancelled = -32800
+RequestTimedOut = -32000
+
+
 class Langserver(object):
+    """
+    A language server process.
+
+    Messages are written by one writer thread per server, and those
+    queued within window seconds of each other are written together.
+    """
 
-    def __init__(self, pwd, cmd, push=None, mock={}):
+    def __init__(self, pwd, cmd, push=None, mock={}, window=0.002):
         self.cbs = {}
+        self.capabilities = {}
         self.diagnostics = defaultdict(dict)
         self.push = push or utils.noop
         self.pwd = pwd
+        self.window = window
+        self.lock = Lock()
+        self.n = 0
+        self.outgoing = Queue()
+        self.sent = {}
+        self.inflight = {}
+        self.cancelled = {}
+        self.latency = defaultdict(lambda: [0, 0.0])
+        self.deadlines = {}
+        self.initialize_result = None
+        self.ready = Event()
+        self.closed = Event()
+        self.roots = [pwd]
+        self.opened = {}
+        self.versions = defaultdict(int)
+        self.stats = {'sent': 0, 'writes': 0, 'cancelled': 0, 'aborted': 0,
+                      'late': 0, 'saved': 0.0, 'timeouts': 0, 'reaped': 0}
 
         if cmd in mock:
             self.proc = mock[cmd]
@@ -31,11 +66,29 @@ class Langserver(object):
             self.proc = Popen(cmd.split(), stdin=PIPE,
                               stdout=PIPE, stderr=sys.stderr)
 
+        # queued first, so that it is sent before any other message
+        rootUri = utils.file_to_uri(self.pwd)
+        self.call('initialize', {
+            'processId': os.getpid(),
+            'rootUri': rootUri,
+            'rootPath': self.pwd,
+            'workspaceFolders': [workspace_folder(self.pwd)],
+            'capabilities': {'workspace': {'workspaceFolders': True}}
+        })(self.initialized)
+
+        writer = Thread(target=self.write)
+        writer.daemon = True
+        writer.start()
+
+        reaper = Thread(target=self.reap)
+        reaper.daemon = True
+        reaper.start()
+
         t = Thread(target=Langserver.spawn, args=(self,))
         t.start()
-        print('thread', t, 'started for', self.proc)
+        log.debug('thread %s started for %s', t, self.proc)
 
-    def craft(self, method, params, cb=None, _private={'n': 0}):
+    def craft(self, method, params, cb=None, supersede=None, timeout=None):
         """
         Assigns to cbs
         """
@@ -43,64 +96,514 @@ class Langserver(object):
             'method': method,
             'params': params
         }
+        superseded = None
         if cb:
-            n = '{}-{}'.format(method, _private['n'])
+            with self.lock:
+                n = '{}-{}'.format(method, self.n)
+                self.n += 1
+                self.cbs[n] = cb
+                self.sent[n] = (method, supersede, time.time())
+                if timeout is not None:
+                    self.deadlines[n] = time.time() + timeout
+                if supersede is not None:
+                    superseded = self.inflight.get(supersede)
+                    self.inflight[supersede] = n
             obj['id'] = n
-            self.cbs[n] = cb
-            _private['n'] += 1
+        if superseded:
+            self.cancel(superseded)
         return utils.jsonrpc(obj)
 
-    def call(self, method, params):
+    def call(self, method, params, supersede=None, timeout=None):
         """
         craft assigns to cbs
+
+        A request made with a supersede key cancels the request made
+        with the same key before it, if that is still in flight.
+        A request still in flight after timeout seconds is cancelled,
+        and its callback gets a RequestTimedOut error.
         """
 
         def k(cb=None):
-            msg = self.craft(method, params, cb)
-            self.proc.stdin.write(msg)
-            self.proc.stdin.flush()
-            print('sent:', method)
+            self.outgoing.put(self.craft(method, params, cb, supersede, timeout))
+            log.debug('queued: %s', method)
         return k
 
+    def cancel(self, id, code=RequestCancelled, message='Superseded by a newer request'):
+        """
+        Cancel the request with id, if it is still in flight.
+
+        Its callback gets an error with code right away, and the
+        response the server may send anyway is dropped.
+
+        >>> server = _FakeServer()
+        >>> ls = server.start()
+        >>> got = Queue()
+        >>> ls.call('textDocument/hover', {}, supersede='k')(got.put)
+        >>> ls.call('textDocument/hover', {}, supersede='k')(got.put)
+        >>> got.get(timeout=5)['error']['code'] == RequestCancelled
+        True
+        >>> first, cancel, second = server.receive(), server.receive(), server.receive()
+        >>> print(first['method'], cancel['method'], second['method'])
+        textDocument/hover $/cancelRequest textDocument/hover
+        >>> cancel['params']['id'] == first['id']
+        True
+
+        The response to the superseded request comes late, and is dropped:
+
+        >>> server.send({'id': first['id'], 'result': 'late'})
+        >>> server.send({'id': second['id'], 'result': 'second'})
+        >>> print(got.get(timeout=5)['result'])
+        second
+        >>> got.empty()
+        True
+        >>> ls.cbs, ls.sent, ls.inflight, ls.cancelled
+        ({}, {}, {}, {})
+        >>> ls.stats['cancelled'], ls.stats['late']
+        (1, 1)
+        >>> server.stop()
+        """
+        with self.lock:
+            cb = self.cbs.pop(id, None)
+            if not cb:
+                return
+            self.deadlines.pop(id, None)
+            self.cancelled[id] = self.sent.pop(id)
+            self.stats['cancelled'] += 1
+        self.outgoing.put(utils.jsonrpc({
+            'method': '$/cancelRequest',
+            'params': {'id': id}
+        }))
+        log.debug('cancelled: %s', id)
+        cb({'id': id, 'error': {'code': code, 'message': message}})
+
+    def reap(self, interval=0.1, forget=60):
+        """
+        Time out requests past their deadline, and forget cancelled
+        requests the server has not answered in forget seconds.
+
+        >>> server = _FakeServer()
+        >>> ls = server.start()
+        >>> got = Queue()
+        >>> ls.call('textDocument/hover', {}, supersede='k', timeout=0.2)(got.put)
+        >>> got.get(timeout=5)['error']['code'] == RequestTimedOut
+        True
+        >>> request, cancel = server.receive(), server.receive()
+        >>> print(cancel['method'], cancel['params']['id'] == request['id'])
+        $/cancelRequest True
+        >>> ls.cbs, ls.sent, ls.inflight, ls.deadlines
+        ({}, {}, {}, {})
+        >>> server.send({'id': request['id'],
+        ...              'error': {'code': RequestCancelled, 'message': 'cancelled'}})
+        >>> server.stop()
+        >>> ls.cancelled, ls.stats['timeouts'], ls.stats['aborted']
+        ({}, 1, 1)
+        """
+        while not self.closed.wait(interval):
+            now = time.time()
+            with self.lock:
+                overdue = [id for id, deadline in six.iteritems(self.deadlines)
+                           if deadline <= now]
+                forgotten = [id for id, (_, _, t) in six.iteritems(self.cancelled)
+                             if t + forget <= now]
+                for id in forgotten:
+                    del self.cancelled[id]
+                for id in overdue:
+                    _, key, _ = self.sent[id]
+                    if key is not None and self.inflight.get(key) == id:
+                        del self.inflight[key]
+                self.stats['timeouts'] += len(overdue)
+                self.stats['reaped'] += len(forgotten)
+            for id in overdue:
+                self.cancel(id, RequestTimedOut, 'Timed out')
+
+    def respond(self, msg):
+        """
+        Call the callback of the request msg is the response to.
+        """
+        id = msg.get('id')
+        now = time.time()
+        with self.lock:
+            cb = self.cbs.pop(id, None)
+            sent = self.sent.pop(id, None)
+            cancelled = self.cancelled.pop(id, None)
+            self.deadlines.pop(id, None)
+            if sent:
+                method, key, t = sent
+                if key is not None and self.inflight.get(key) == id:
+                    del self.inflight[key]
+                self.latency[method][0] += 1
+                self.latency[method][1] += now - t
+            elif cancelled:
+                method, key, t = cancelled
+                if msg.get('error', {}).get('code') == RequestCancelled:
+                    self.stats['aborted'] += 1
+                    count, total = self.latency[method]
+                    if count:
+                        self.stats['saved'] += max(0.0, total / count - (now - t))
+                else:
+                    self.stats['late'] += 1
+                    log.debug('dropped late response to %s', id)
+        if cb:
+            if 'error' in msg:
+                log.error('error %s', utils.lazy(pprint.pformat, msg))
+            cb(msg)
+
+    def answer(self, msg):
+        r"""
+        Answer msg, a request from the server.
+
+        >>> ls = Langserver.__new__(Langserver)
+        >>> ls.lock, ls.outgoing, ls.roots = Lock(), Queue(), ['/a', '/b']
+        >>> def answered():
+        ...     return json.loads(utils.decode(ls.outgoing.get()).partition('\r\n\r\n')[2])
+        >>> ls.answer({'id': 1, 'method': 'workspace/workspaceFolders'})
+        >>> answered()['result'] == [workspace_folder('/a'), workspace_folder('/b')]
+        True
+        >>> ls.answer({'id': 2, 'method': 'window/workDoneProgress/create'})
+        >>> answered()['error']['code'] == MethodNotFound
+        True
+        """
+        reply = {'id': msg['id']}
+        if msg['method'] == 'workspace/workspaceFolders':
+            with self.lock:
+                roots = list(self.roots)
+            reply['result'] = [workspace_folder(root) for root in roots]
+        else:
+            log.debug('no answer to %s', msg['method'])
+            reply['error'] = {'code': MethodNotFound,
+                              'message': 'Method not found: ' + msg['method']}
+        self.outgoing.put(utils.jsonrpc(reply))
+
+    def write(self):
+        """
+        Write queued messages to the server until it goes away, or
+        until None is queued.
+        """
+        stop = False
+        while not stop:
+            msgs = [self.outgoing.get()]
+            deadline = time.time() + self.window
+            while True:
+                try:
+                    msgs.append(self.outgoing.get(timeout=max(0, deadline - time.time())))
+                except Empty:
+                    break
+            stop = None in msgs
+            msgs = [msg for msg in msgs if msg is not None]
+            try:
+                writes = utils.writev(self.proc.stdin, msgs) if msgs else 0
+            except (IOError, OSError, ValueError) as e:
+                if not self.closed.is_set():
+                    log.error('could not write to langserver: %s', e)
+                break
+            with self.lock:
+                self.stats['sent'] += len(msgs)
+                self.stats['writes'] += writes
+        getattr(self.proc.stdin, 'close', utils.noop)()
+
+    def close(self):
+        """
+        Called when the server has closed its output. Fails the requests
+        still waiting for it, stops the writer and reaper threads and
+        waits for the process to exit.
+        """
+        self.closed.set()
+        with self.lock:
+            ids = list(self.cbs)
+        for id in ids:
+            self.cancel(id, InternalError, 'The language server exited')
+        self.outgoing.put(None)
+        getattr(self.proc, 'wait', utils.noop)()
+        getattr(self.proc.stdout, 'close', utils.noop)()
+        log.debug('langserver %s exited', self.proc)
+
+    def initialized(self, msg):
+        result = msg.get('result', {})
+        self.capabilities = result.get('capabilities', {})
+        self.initialize_result = result
+        self.ready.set()
+        self.push('initialize', result)
+
+    def next_version(self, uri):
+        """
+        The version to send with the next change of the document at uri.
+        Kakoune timestamps are per session, so they cannot be used when
+        sessions share the server.
+
+        >>> ls = Langserver.__new__(Langserver)
+        >>> ls.lock, ls.versions = Lock(), defaultdict(int)
+        >>> ls.next_version('file:///a'), ls.next_version('file:///a')
+        (1, 2)
+        """
+        with self.lock:
+            self.versions[uri] += 1
+            return self.versions[uri]
+
+    def shutdown(self):
+        """
+        Ask the server to shut down, and then to exit.
+        """
+        self.call('shutdown', None, timeout=5)(lambda msg: self.call('exit', None)())
+
+    def supports_folders(self):
+        """
+        Whether the server can have workspace folders added after it
+        has been initialized.
+
+        >>> ls = Langserver.__new__(Langserver)
+        >>> ls.capabilities = {'workspace': {'workspaceFolders': {
+        ...     'supported': True, 'changeNotifications': True}}}
+        >>> ls.supports_folders()
+        True
+        >>> ls.capabilities = {'workspace': {'workspaceFolders': {'supported': True}}}
+        >>> ls.supports_folders()
+        False
+        >>> ls.capabilities = {}
+        >>> ls.supports_folders()
+        False
+        """
+        folders = self.capabilities.get('workspace', {}).get('workspaceFolders', {})
+        return bool(folders.get('supported') and folders.get('changeNotifications'))
+
+    def add_root(self, root):
+        """
+        Add root as a workspace folder of the server. Returns False if the
+        server is not initialized yet or does not support workspace
+        folders, so that callers never wait for it.
+        """
+        if not self.ready.is_set() or not self.supports_folders():
+            return False
+        with self.lock:
+            if root in self.roots:
+                return True
+            self.roots.append(root)
+        self.call('workspace/didChangeWorkspaceFolders', {
+            'event': {'added': [workspace_folder(root)], 'removed': []}
+        })()
+        log.info('added workspace folder %s', root)
+        return True
+
+    def sync_kind(self):
+        """
+        The TextDocumentSyncKind the server wants didChange in:
+        0 for none, 1 for the full text and 2 for incremental changes.
+
+        >>> ls = Langserver.__new__(Langserver)
+        >>> ls.capabilities = {'textDocumentSync': {'openClose': True, 'change': 2}}
+        >>> ls.sync_kind()
+        2
+        >>> ls.capabilities = {}
+        >>> ls.sync_kind()
+        1
+        """
+        sync = self.capabilities.get('textDocumentSync', 1)
+        if isinstance(sync, dict):
+            return sync.get('change', 1)
+        return sync
+
     def spawn(self):
 
-        rootUri = 'file://' + self.pwd
+        stdout = self.proc.stdout
+        read = getattr(stdout, 'read1', None)
+        if not read:
+            read = functools.partial(os.read, stdout.fileno())
+        for view in utils.frames(read):
+            if not view:
+                continue
+            try:
+                msg = json.loads(utils.decode_view(view))
+            except Exception:
+                if not stdout.closed:
+                    log.error('Error deserializing server output: %s',
+                              utils.decode_view(view))
+                continue
+            log.debug('Response from langserver: %s', utils.lazy(
+                lambda: '\n'.join(pprint.pformat(msg).split('\n')[:40])))
+            if 'id' in msg and 'method' in msg:
+                self.answer(msg)
+            elif 'id' in msg:
+                self.respond(msg)
+            elif 'method' in msg:
+                self.push(msg['method'], msg.get('params'))
+        self.close()
 
-        self.call('initialize', {
-            'processId': os.getpid(),
-            'rootUri': rootUri,
-            'rootPath': self.pwd,
-            'capabilities': {}
-        })(lambda msg: self.push('initialize', msg.get('result', {})))
-
-        contentLength = 0
-        while not self.proc.stdout.closed:
-            line = self.proc.stdout.readline().decode('utf-8').strip()
-            # typescript-langserver has this extra Header:
-            line = utils.drop_prefix(line, 'Header:  ')
-            if line:
-                header, value = line.split(":")
-                if header == "Content-Length":
-                    contentLength = int(value)
+
+def workspace_folder(root):
+    """
+    >>> workspace_folder('/home/me/my proj') == {'uri': 'file:///home/me/my%20proj',
+    ...                                          'name': 'my proj'}
+    True
+    """
+    return {'uri': utils.file_to_uri(root),
+            'name': os.path.basename(root.rstrip('/')) or root}
+
+
+class _FakeServer(object):
+    """
+    A language server process for doctests, backed by pipes: requests
+    are read with receive and messages are written with send.
+    """
+
+    def __init__(self):
+        self.input, stdin = os.pipe()
+        stdout, output = os.pipe()
+        # the ends used by Langserver, as with a Popen
+        self.stdin = os.fdopen(stdin, 'wb')
+        self.stdout = os.fdopen(stdout, 'rb')
+        self.output = os.fdopen(output, 'wb')
+        self.requests = utils.frames(functools.partial(os.read, self.input))
+
+    def start(self, capabilities={}):
+        """
+        A Langserver talking to this server, initialized with capabilities.
+        """
+        return self.initialize(Langserver('/tmp', 'fake', mock={'fake': self}),
+                               capabilities)
+
+    def initialize(self, langserver, capabilities={}):
+        """
+        Answer the initialize request of langserver, which talks to this
+        server, and wait for it to be handled.
+        """
+        self.langserver = langserver
+        initialize = self.receive()
+        self.send({'id': initialize['id'], 'result': {'capabilities': capabilities}})
+        self.langserver.ready.wait(5)
+        return self.langserver
+
+    def receive(self):
+        return json.loads(utils.decode_view(next(self.requests)))
+
+    def send(self, msg):
+        self.output.write(utils.jsonrpc(msg))
+        self.output.flush()
+
+    def stop(self):
+        """
+        Close the output of the server, and wait for the Langserver to
+        notice.
+        """
+        self.output.close()
+        self.langserver.closed.wait(5)
+        os.close(self.input)
+
+
+class Servers(object):
+    """
+    The language servers of a process, one per command and project root,
+    shared by the clients of all Kakoune sessions attached to it.
+    Once initialized, a server supporting workspace folders is reused for
+    the other project roots of its command, which are added as folders
+    to it.
+
+    Servers are reference counted by the sessions using them. Once no
+    session has used a server for idle seconds it is shut down, unless
+    idle is None. Notifications from a server go to every session using it.
+
+    >>> server, servers = _FakeServer(), Servers(idle=0.1)
+    >>> a = servers.get('fake', '/tmp', 'a', utils.noop, mock={'fake': server})
+    >>> a is server.initialize(a)
+    True
+    >>> pushed = []
+    >>> b = servers.get('fake', '/tmp', 'b', lambda *m: pushed.append(m), mock={'fake': server})
+    >>> a is b, pushed == [('initialize', {'capabilities': {}})]
+    (True, True)
+    >>> servers.stats()['fake /tmp']['sessions']
+    2
+    >>> servers.release('a')
+    >>> time.sleep(0.3)
+    >>> servers.stats()['fake /tmp']['sessions']
+    1
+    >>> servers.release('b')
+    >>> shutdown = server.receive()
+    >>> print(shutdown['method'])
+    shutdown
+    >>> servers.stats()
+    {}
+    >>> server.send({'id': shutdown['id'], 'result': None})
+    >>> print(server.receive()['method'])
+    exit
+    >>> server.stop()
+    """
+
+    def __init__(self, idle=None):
+        self.idle = idle
+        self.lock = Lock()
+        self.servers = {}
+        self.aliases = {}
+        self.pushes = defaultdict(dict)
+        self.timers = {}
+
+    def get(self, cmd, root, session, push, mock={}):
+        """
+        The server running cmd in root for session, started if needed.
+        push is called with the notifications of the server.
+        """
+        key = (cmd, root)
+        with self.lock:
+            key = self.aliases.get(key) or self.share(key)
+            self.pushes[key][session] = push
+            timer = self.timers.pop(key, None)
+            if timer:
+                timer.cancel()
+            if key in self.servers:
+                langserver = self.servers[key]
+                result = langserver.initialize_result
             else:
-                content = self.proc.stdout.read(contentLength).decode('utf-8')
-                if content == "":
-                    continue
-                try:
-                    msg = json.loads(content)
-                except Exception:
-                    if not self.proc.stdout.closed:
-                        msg = "Error deserializing server output: " + content
-                        print(msg, file=sys.stderr)
-                    continue
-                print('Response from langserver:', '\n'.join(
-                    pprint.pformat(msg).split('\n')[:40]))
-                if msg.get('id') in self.cbs:
-                    cb = self.cbs[msg['id']]
-                    del self.cbs[msg['id']]
-                    if 'error' in msg:
-                        print('error', pprint.pformat(msg), file=sys.stderr)
-                    cb(msg)
-                if 'id' not in msg and 'method' in msg:
-                    self.push(msg['method'], msg.get('params'))
+                langserver = self.servers[key] = Langserver(
+                    root, cmd, functools.partial(self.push, key), mock)
+                result = None
+        if result is not None:
+            push('initialize', result)
+        return langserver
+
+    def share(self, key):
+        """
+        The key of the server to use for key: its own if it is running,
+        or that of an initialized server of the same command which its
+        root was added to. Should be called with the lock held.
+        """
+        if key in self.servers:
+            return key
+        cmd, root = key
+        for other, langserver in six.iteritems(self.servers):
+            if other[0] == cmd and langserver.add_root(root):
+                self.aliases[key] = other
+                return other
+        return key
+
+    def push(self, key, method, params):
+        with self.lock:
+            pushes = list(six.itervalues(self.pushes[key]))
+        for push in pushes:
+            push(method, params)
+
+    def release(self, session):
+        """
+        Stop using the servers of session.
+        """
+        with self.lock:
+            for key, pushes in six.iteritems(self.pushes):
+                if pushes.pop(session, None) and not pushes and \
+                        self.idle is not None and key in self.servers:
+                    timer = self.timers[key] = Timer(self.idle, self.stop, [key])
+                    timer.daemon = True
+                    timer.start()
+
+    def stop(self, key):
+        with self.lock:
+            if self.pushes[key] or key not in self.servers:
+                return
+            self.timers.pop(key, None)
+            langserver = self.servers.pop(key)
+            for alias, other in list(six.iteritems(self.aliases)):
+                if other == key:
+                    del self.aliases[alias]
+        log.info('shutting down idle server %s in %s', *key)
+        langserver.shutdown()
 
+    def stats(self):
+        with self.lock:
+            return {' '.join(key): {'sessions': len(self.pushes[key]),
+                                    'roots': list(langserver.roots)}
+                    for key, langserver in six.iteritems(self.servers)}
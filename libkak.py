@@ -2,19 +2,26 @@
 
 from __future__ import print_function
 from six.moves.queue import Queue
+from collections import OrderedDict
 from subprocess import Popen, PIPE
-from threading import Thread
+from threading import Thread, Event, Lock, Timer
 import functools
 import itertools as it
+import logging
 import os
 import re
 import six
+import socket
+import struct
 import sys
 import tempfile
 import time
 import utils
 
 
+log = logging.getLogger('libkak')
+
+
 class Remote(object):
 
     def __init__(self, session):
@@ -26,10 +33,15 @@ class Remote(object):
         self.argnames = []
         self.sync_setup = False
         self.required_names = {'client'}
+        self.serving = False
+        self.concurrency = None
+        self.supersede = False
+        self.counted = False
+        self.inbox = Queue()
 
         def ret():
             x = self.listen()
-            self.fifo_cleanup()
+            self.unregister()
             return x
         self.ret = ret
 
@@ -77,16 +89,19 @@ class Remote(object):
 
     @staticmethod
     def hook(self_or_session, scope, name, group=None, filter='.*',
-             sync_setup=False, client=None):
+             sync_setup=False, client=None, concurrency=None, supersede=False):
         r = Remote._resolve(self_or_session)
         r.sync_setup = sync_setup
+        r.concurrency = concurrency
+        r.supersede = supersede
         group = ' -group ' + group if group else ''
         filter = utils.single_quoted(filter)
         cmd = 'hook' + group + ' ' + scope + ' ' + name + ' ' + filter + ' %('
         r_pre = r.pre
         r.pre = lambda f: cmd + r_pre(f)
         r.post = ')' + r.post
-        r.ret = lambda: utils.fork(loop=True)(r.listen)
+        r.serving = True
+        r.ret = utils.noop
         if client:
             r.onclient(r, client)
         return r
@@ -96,13 +111,24 @@ class Remote(object):
 
     @staticmethod
     def command(self_or_session, params='0', enum=[],
-                sync_setup=False, sync_python_calls=False, hidden=False):
+                sync_setup=False, sync_python_calls=False, hidden=False,
+                concurrency=None, supersede=False):
+        """
+        Define a Kakoune command which calls the decorated function.
+
+        Calls are handled by the worker pool. At most concurrency calls
+        of the command run at the same time, and if supersede is true,
+        calls still waiting for a worker are dropped when a new one
+        arrives. Calls Kakoune waits for a reply to get a spare worker
+        when the pool is busy.
+        """
         r = Remote._resolve(self_or_session)
         r.sync_setup = sync_setup
+        r.serving = True
+        r.concurrency = concurrency
+        r.supersede = supersede
 
         def ret():
-            utils.fork(loop=True)(r.listen)
-
             @functools.wraps(r.f)
             def call_from_python(client, *args):
                 escaped = [utils.single_quoted(arg) for arg in args]
@@ -137,7 +163,9 @@ class Remote(object):
         return list(names)
 
     @staticmethod
-    def _msg(splices, fifo):
+    def _msg(splices, fifo, id, counted=False):
+        if counted:
+            return Remote._counted_msg(splices, fifo, id)
         underscores = []
         argsplice = []
         for s in splices:
@@ -152,34 +180,89 @@ class Remote(object):
             m.append('for __arg; do __args="${__args}_S${__arg//_/_u}"; done')
 
         m.append(underscores)
-        m.append('echo -n "' + argsplice + '" > ' + fifo)
+        m.append('echo "' + id + ':' + argsplice + '" > ' + fifo)
+        return '\n'.join(m)
+
+    @staticmethod
+    def _counted_msg(splices, fifo, id):
+        """
+        Write each value prefixed by its length in bytes, and the whole
+        message prefixed by a header line with the id and its length.
+        Lengths are taken in the C locale to count bytes.
+        """
+        m = ['__lc_all=$LC_ALL', 'LC_ALL=C', '__msg=""']
+        if '__args' in splices:
+            m.append('__args=""')
+            m.append('for __arg; do __args+="${#__arg}:${__arg}"; done')
+        for s in splices:
+            m.append('__msg+="${#' + s + '}:${' + s + '}"')
+        m.append('printf "%s#%d\\n%s" ' + id + ' "${#__msg}" "$__msg" > ' + fifo)
+        m.append('LC_ALL=$__lc_all')
         return '\n'.join(m)
 
     def __call__(self, f):
         self.f = f
-        splices, self.parse = Args.argsetup(self._argnames(), self.arg_config)
-        self.fifo, self.fifo_cleanup = _mkfifo()
-        msg = self.pre(f) + self._msg(splices, self.fifo) + self.post
+        self.call_f = utils.kwcaller(f) if self.puns else f
+        splices, self.parse = Args.argsetup(self._argnames(), self.arg_config,
+                                            self.counted)
+        dispatcher = _dispatcher(self.session)
+        self.fifo = dispatcher.fifo
+        self.id = dispatcher.register(self)
+        self.key = self.f.__name__ + '#' + self.id
+        self.unregister = functools.partial(dispatcher.unregister, self.id)
+        msg = self.pre(f) + self._msg(splices, self.fifo, self.id, self.counted) + self.post
         pipe(self.session, msg, sync=self.sync_setup)
         return self.ret()
 
+    def deliver(self, line):
+        """
+        Called by the Dispatcher with a message for this Remote.
+        """
+        if self.serving:
+            # Kakoune is blocked until a call with a reply channel is
+            # answered, so those calls must not wait for other handlers
+            pool.submit(self.key, functools.partial(self.handle, line),
+                        limit=self.concurrency, supersede=self.supersede,
+                        drop=functools.partial(self.drop, line),
+                        spare='reply_fifo' in self.required_names)
+        else:
+            self.inbox.put(line)
+
+    def drop(self, line):
+        """
+        Called instead of handle for a call that was superseded.
+
+        Kakoune waits for a reply if there is a reply channel, so an
+        empty one is sent.
+        """
+        _debug(self.f.__name__, self.id, 'dropped:', utils.lazy(repr, line))
+        reply_fifo = self.parse(line).get('reply_fifo')
+        if reply_fifo:
+            with open(reply_fifo, 'w') as fp:
+                fp.write('')
+
     def listen(self):
-        _debug(self.f.__name__ + ' ' + self.fifo + ' waiting for call...')
-        with open(self.fifo, 'r') as fp:
-            line = utils.decode(fp.readline()).rstrip()
-            if line == '_q':
-                self.fifo_cleanup()
-                _debug(self.fifo, 'demands quit')
-                raise RuntimeError('fifo demands quit')
-            _debug(self.f.__name__ + ' ' + self.fifo + ' replied:' + repr(line))
+        _debug(self.f.__name__, self.id, 'waiting for call...')
+        line = self.inbox.get()
+        if line == '_q':
+            _debug(self.id, 'demands quit')
+            raise RuntimeError('fifo demands quit')
+        return self.handle(line)
+
+    def _pipe_for(self, client):
+        def _pipe(msg, sync=False):
+            return pipe(self.session, msg, client, sync)
+        return _pipe
+
+    def handle(self, line):
+        _debug(self.f.__name__, self.id, 'replied:', utils.lazy(repr, line))
 
         r = self.parse(line)
 
         try:
-            def _pipe(msg, sync=False):
-                return pipe(self.session, msg, r['client'], sync)
-            r['pipe'] = _pipe
+            r['pipe'] = self._pipe_for(r['client'])
             d = {}
+            check = utils.noop
             if 'reply_fifo' in r:
                 d['reply_calls'] = 0
 
@@ -188,15 +271,21 @@ class Remote(object):
                     with open(r['reply_fifo'], 'w') as fp:
                         fp.write(msg)
                 r['reply'] = reply
-            result = utils.safe_kwcall(self.f, r) if self.puns else self.f(r)
-            if 'reply_fifo' in r:
-                if d['reply_calls'] != 1:
-                    print('!!! [ERROR] Must make exactly 1 call to reply, ' +
-                          self.f + ' ' + self.r + ' made ' + d['reply_calls'],
-                          file=sys.stderr)
-            return result
+
+                def check():
+                    if d['reply_calls'] != 1:
+                        log.error('Must make exactly 1 call to reply, %s made %s',
+                                  self.f.__name__, d['reply_calls'])
+            return self._finish(self.call_f(r), check)
         except TypeError as e:
-            print(str(e), file=sys.stderr)
+            log.error('%s', e)
+
+    def _finish(self, result, check):
+        """
+        Call check once the handler is done, and return its result.
+        """
+        check()
+        return result
 
 
 def pipe(session, msg, client=None, sync=False):
@@ -217,32 +306,354 @@ def pipe(session, msg, client=None, sync=False):
     test
     0
     """
-    if client:
-        import tempfile
-        name = tempfile.mktemp()
-        with open(name, 'wb') as tmp:
-            tmp.write(utils.encode(msg))
-        msg = u'eval -client {} "%sh`cat {}; rm {}`"'.format(client, name, name)
     if sync:
-        fifo, fifo_cleanup = _mkfifo()
-        msg += u'\n%sh(echo done > {})'.format(fifo)
+        done = Event()
+        _pipe(session, msg, client, done.set)
+        _debug('waiting for completion...', utils.lazy(lambda: msg.replace('\n', ' ')[:60]))
+        done.wait()
+        _debug('done')
+    else:
+        _pipe(session, msg, client)
+
+
+def _pipe(session, msg, client=None, done=None):
+    """
+    Send msg to session, calling done when it has been executed if given.
+    """
+    if client:
+        msg = u'eval -client {} {}'.format(client, _client_quoted(msg))
+    if done:
+        msg += u'\n' + _acks().ack(done)
     # _debug('piping: ', msg.replace('\n', ' ')[:70])
     _debug('piping: ', msg)
     if hasattr(session, '__call__'):
         session(msg)
     else:
-        p = Popen(['kak', '-p', str(session).rstrip()], stdin=PIPE)
-        p.stdin.write(utils.encode(msg))
-        p.stdin.flush()
-        p.stdin.close()
-    if sync:
-        _debug(fifo + ' waiting for completion...',
-               msg.replace('\n', ' ')[:60])
-        with open(fifo, 'r') as fifo_fp:
-            fifo_fp.readline()
-        _debug(fifo + ' going to clean up...')
-        fifo_cleanup()
-        _debug(fifo + ' done')
+        connect(session)(msg)
+
+
+class Session(object):
+    """
+    A connection to a running Kakoune session.
+
+    Commands are written straight to the session socket using Kakoune's
+    remote protocol, which saves starting a `kak -p` process per message.
+    If the socket cannot be found or connected to, `kak -p` is used.
+
+    Kakoune closes a command connection after evaluating it, so what is
+    kept for the life of the object is the resolved socket path.
+
+    Instances are callable and can be used as the session argument of
+    `pipe` and `Remote`.
+    """
+
+    def __init__(self, session):
+        self.session = str(session).rstrip()
+        self.path = _socket_path(self.session)
+
+    def __str__(self):
+        return self.session
+
+    def __call__(self, msg):
+        if not self.path:
+            self.path = _socket_path(self.session)
+        if self.path:
+            try:
+                self.send(msg)
+                return
+            except socket.error as e:
+                _debug('socket', self.path, 'unavailable:', e)
+                self.path = None
+        _kak_p(self.session, msg)
+
+    def send(self, msg):
+        """
+        Send msg over the session socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(_command_message(msg))
+        finally:
+            sock.close()
+
+
+def connect(session, _sessions={}):
+    """
+    Return a Session for session, reusing an earlier one if possible.
+
+    >>> s = connect(4032)
+    >>> connect('4032') is s and connect(s) is s
+    True
+    >>> print(s)
+    4032
+    """
+    if isinstance(session, Session):
+        return session
+    name = str(session).rstrip()
+    if name not in _sessions:
+        _sessions[name] = Session(name)
+    return _sessions[name]
+
+
+_report_error = ' catch %{ echo -debug "libkak: %val{error}" }'
+
+
+class Batcher(object):
+    """
+    Queue outgoing commands and send them to a session in batches.
+
+    Everything queued within window seconds, or until max_size bytes have
+    been queued, is sent as one block per client. Commands queued with
+    the same key replace each other, so that only the latest is sent.
+    Commands are wrapped in try when batched, so that one failing command
+    does not abort the rest of the block, and their errors are written to
+    the debug buffer.
+
+    >>> sent = []
+    >>> b = Batcher(sent.append, window=60)
+    >>> b('echo one')
+    >>> b('set buffer=a lsp_flags 1', key='flags')
+    >>> b('set buffer=a lsp_flags 2', key='flags')
+    >>> b.flush()
+    >>> print(sent[0])
+    try 'echo one' catch %{ echo -debug "libkak: %val{error}" }
+    try 'set buffer=a lsp_flags 2' catch %{ echo -debug "libkak: %val{error}" }
+    >>> sorted(b.stats.items())
+    [('batches', 1), ('coalesced', 1), ('queued', 3), ('saved', 2)]
+    """
+
+    def __init__(self, session, window=0.005, max_size=64 * 1024):
+        self.session = session
+        self.window = window
+        self.max_size = max_size
+        self.pending = OrderedDict()
+        self.size = 0
+        self.timer = None
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.n = 0
+        self.closed = False
+        self.stats = {'queued': 0, 'coalesced': 0, 'batches': 0, 'saved': 0}
+
+    def __call__(self, msg, client=None, key=None):
+        """
+        Queue msg to be sent to client.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.stats['queued'] += 1
+            if key is None:
+                self.n += 1
+                key = ('_', self.n)
+            k = (client, key)
+            if k in self.pending:
+                self.stats['coalesced'] += 1
+                self.size -= len(self.pending.pop(k))
+            self.pending[k] = msg
+            self.size += len(msg)
+            full = self.size >= self.max_size
+            if not full and not self.timer:
+                self.timer = Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Send everything queued now.
+        """
+        with self.send_lock:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+                self.size = 0
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+            clients = OrderedDict()
+            for (client, _), msg in six.iteritems(pending):
+                clients.setdefault(client, []).append(msg)
+            for client, msgs in six.iteritems(clients):
+                if len(msgs) == 1:
+                    msg = msgs[0]
+                else:
+                    msg = '\n'.join('try ' + utils.single_quoted(m) + _report_error
+                                     for m in msgs)
+                pipe(self.session, msg, client)
+            with self.lock:
+                self.stats['batches'] += len(clients)
+                self.stats['saved'] = (self.stats['queued'] -
+                                       self.stats['batches'])
+
+    def close(self):
+        """
+        Drop everything queued, and ignore what is queued from now on.
+        """
+        with self.lock:
+            self.closed = True
+            self.pending = OrderedDict()
+            self.size = 0
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+
+class Dispatcher(object):
+    """
+    The channel a Kakoune session uses to send calls to the Remotes of
+    this process.
+
+    The Remotes of a session share one fifo. Each message is a line
+    starting with the id of the Remote it is for, and a listener routes
+    it to that Remote. For Remotes using the counted wire format, the
+    line has the id and the length of the message, which follows it.
+    Kakoune runs one shell at a time, so messages from a session are
+    never interleaved. Each session gets a Dispatcher of its own, since
+    the messages of two sessions could be.
+    """
+
+    _ids = it.count(1)
+
+    def __init__(self):
+        self.fifo, self.cleanup = _mkfifo()
+        self.lock = Lock()
+        self.remotes = {}
+        self.alive = True
+        utils.fork(loop=True)(self.listen)
+
+    def register(self, remote):
+        """
+        Route messages for a new id to remote and return the id.
+        Ids are unique in the process, so they can key the pool.
+        """
+        with self.lock:
+            id = str(next(Dispatcher._ids))
+            self.remotes[id] = remote
+        return id
+
+    def unregister(self, id):
+        with self.lock:
+            self.remotes.pop(id, None)
+
+    def listen(self):
+        with open(self.fifo, 'rb') as fp:
+            while True:
+                line = fp.readline()
+                if not line:
+                    return
+                counted = re.match(b'^(\\d+)#(\\d+)$', line.rstrip(b'\n'))
+                if counted:
+                    id = utils.decode(counted.group(1))
+                    msg = fp.read(int(counted.group(2)))
+                else:
+                    line = utils.decode(line).rstrip('\n')
+                    if line == '_q':
+                        self.quit()
+                        raise RuntimeError('fifo demands quit')
+                    id, _, msg = line.partition(':')
+                with self.lock:
+                    remote = self.remotes.get(id)
+                if remote:
+                    remote.deliver(msg)
+                else:
+                    _debug('no remote with id', id, 'for', repr(msg))
+
+    def quit(self):
+        """
+        Stop this dispatcher, and make Remotes waiting for calls quit.
+        """
+        with self.lock:
+            self.alive = False
+            remotes, self.remotes = self.remotes, {}
+        self.cleanup()
+        _debug(self.fifo, 'demands quit')
+        for remote in six.itervalues(remotes):
+            if remote.serving:
+                pool.forget(remote.key)
+            else:
+                remote.deliver('_q')
+
+    def close(self):
+        """
+        Make the listener quit.
+        """
+        with open(self.fifo, 'w') as fd:
+            fd.write('_q\n')
+
+
+class AckPool(object):
+    """
+    Long-lived fifos for acknowledging synchronous pipe calls.
+
+    Each call gets a token, which Kakoune echoes back to one of the
+    fifos when it has executed the commands. A listener per fifo calls
+    the function registered for that token, so any number of threads
+    can share the fifos.
+
+    >>> pool = AckPool(size=1)
+    >>> done = Event()
+    >>> ack = pool.ack(done.set)
+    >>> Popen(['sh', '-c', ack[len('%sh('):-1]]).wait()
+    0
+    >>> done.wait()
+    True
+    >>> _fifo_cleanup()
+    """
+
+    def __init__(self, size=2):
+        self.lock = Lock()
+        self.n = 0
+        self.waiting = {}
+        self.alive = True
+        self.fifos = []
+        for _ in range(size):
+            fifo, cleanup = _mkfifo()
+            self.fifos.append(fifo)
+            utils.fork(loop=True)(functools.partial(self.listen, fifo, cleanup))
+
+    def ack(self, done):
+        """
+        Return a command that acknowledges a call by calling done.
+        """
+        with self.lock:
+            self.n += 1
+            token = str(self.n)
+            fifo = self.fifos[self.n % len(self.fifos)]
+            self.waiting[token] = done
+        return u'%sh(echo {} > {})'.format(token, fifo)
+
+    def listen(self, fifo, cleanup):
+        with open(fifo, 'r') as fp:
+            while True:
+                token = fp.readline().strip()
+                if not token:
+                    return
+                if token == '_q':
+                    self.quit()
+                    cleanup()
+                    _debug(fifo, 'demands quit')
+                    raise RuntimeError('fifo demands quit')
+                with self.lock:
+                    done = self.waiting.pop(token, None)
+                if done:
+                    done()
+
+    def quit(self):
+        """
+        Stop using this pool and wake up everyone still waiting.
+        """
+        with self.lock:
+            self.alive = False
+            waiting, self.waiting = self.waiting, {}
+        for done in six.itervalues(waiting):
+            done()
+
+
+# Handlers of commands and hooks run in this pool. Replace it to change
+# the number of workers.
+pool = utils.Pool(workers=8)
 
 
 #############################################################################
@@ -320,8 +731,14 @@ class Args(object):
     def selection_desc(x):
         """
         Parse a Kakoune selection description.
+
+        >>> Args.selection_desc('1.2,3.45')
+        ((1, 2), (3, 45))
         """
-        return tuple(map(Args.coord, x.split(',')))
+        anchor, cursor = x.split(',')
+        y0, x0 = anchor.split('.')
+        y1, x1 = cursor.split('.')
+        return ((int(y0), int(x0)), (int(y1), int(x1)))
 
     @staticmethod
     def string(x):
@@ -347,20 +764,45 @@ class Args(object):
         ...     assert(xs == xs2)
         >>> for n in range(0, 10):
         ...     test(n)
+        >>> Args.listof(Args.string)('a\nb:c\\\\:d\\:')
+        ['a\nb', 'c\\', 'd:']
 
         """
-        def rmlastcolon(s):
-            if s and s[-1] == ':':
-                return s[:-1]
-            else:
-                return s
+        def inner(s):
+            return list(Args.iterlistof(p)(s))
+        return inner
 
+    @staticmethod
+    def iterlistof(p):
+        r"""
+        Parse a Kakoune list of p lazily, in one pass over the string.
+
+        >>> xs = Args.iterlistof(Args.selection_desc)('1.1,1.2:3.4,5.6')
+        >>> next(xs)
+        ((1, 1), (1, 2))
+        >>> list(xs)
+        [((3, 4), (5, 6))]
+
+        A trailing unescaped colon does not start another element:
+
+        >>> list(Args.iterlistof(Args.string)('a:b:'))
+        ['a', 'b']
+        >>> list(Args.iterlistof(Args.string)('a\\\\:'))
+        ['a\\']
+        """
         def inner(s):
-            ms = [m.group(0)
-                  for m in re.finditer(r'(.*?(?<!\\)(\\\\)*:|.+)', s)]
-            ms = [m if i == len(ms) - 1 else rmlastcolon(m)
-                  for i, m in enumerate(ms)]
-            return [p(re.sub(r'\\(.)', '\g<1>', x)) for x in ms]
+            if not s:
+                return
+            pos = 0
+            while True:
+                m = _list_element.match(s, pos)
+                x = m.group(1)
+                if '\\' in x:
+                    x = _list_escape.sub(r'\g<1>', x)
+                yield p(x)
+                pos = m.end()
+                if not m.group(2) or pos == len(s):
+                    return
         return inner
 
     @staticmethod
@@ -375,8 +817,36 @@ class Args(object):
         return tuple(x.replace('_u', '_') for x in s.split('_S')[1:])
 
     @staticmethod
-    def argsetup(argnames, config):
+    def fields(data):
         """
+        Split bytes of length-prefixed fields into memoryview slices.
+
+        >>> [v.tobytes() for v in Args.fields(b'3:a:b0:2:\\n\\n')] == [b'a:b', b'', b'\\n\\n']
+        True
+        """
+        view = memoryview(data)
+        fields = []
+        i = 0
+        while i < len(data):
+            j = data.index(b':', i)
+            end = j + 1 + int(data[i:j])
+            fields.append(view[j + 1:end])
+            i = end
+        return fields
+
+    @staticmethod
+    def counted_args_parse(s):
+        return tuple(utils.decode_view(v) for v in Args.fields(utils.encode(s)))
+
+    @staticmethod
+    def argsetup(argnames, config, counted=False):
+        """
+        Return the variables to splice for argnames, and a function parsing
+        the message made from them.
+
+        If counted is true, the message is bytes of length-prefixed fields,
+        otherwise a line of escaped fields.
+
         >>> s, _ = Args.argsetup('client cmd reply'.split(), {'cmd': ('a', int)})
         >>> print(s)
         ['kak_client', 'a']
@@ -389,11 +859,20 @@ class Args(object):
                     splice, parse = config[name]
                 else:
                     splice, parse = _arg_config[name]
+                if counted and splice == '__args':
+                    parse = Args.counted_args_parse
                 splices.append(splice)
                 args.append((name, parse))
             except KeyError:
                 pass
 
+        if counted:
+            def parse(data):
+                _debug(argnames, data)
+                return {name: parse(utils.decode_view(value))
+                        for (name, parse), value in zip(args, Args.fields(data))}
+            return splices, parse
+
         def parse(line):
             _debug(argnames, line)
             params = [v.replace('_n', '\n').replace('_u', '_')
@@ -403,6 +882,10 @@ class Args(object):
         return splices, parse
 
 
+_list_element = re.compile(r'((?:[^\\:]+|\\.?)*)(:?)', re.DOTALL)
+_list_escape = re.compile(r'\\(.)', re.DOTALL)
+
+
 _arg_config = {
     'line':   ('kak_cursor_line',   int),
     'column': ('kak_cursor_column', int),
@@ -471,6 +954,109 @@ def _mkfifo(active_fifos={}):
     return fifo, rm
 
 
+def _session_key(session):
+    if isinstance(session, Session) or not hasattr(session, '__call__'):
+        return str(session).rstrip()
+    return session
+
+
+def _dispatcher(session, _current={}, _lock=Lock()):
+    """
+    The Dispatcher of session, started when first needed.
+    """
+    key = _session_key(session)
+    with _lock:
+        if key not in _current or not _current[key].alive:
+            _current[key] = Dispatcher()
+        return _current[key]
+
+
+def disconnect(session):
+    """
+    Stop serving the Remotes of session, and forget them.
+    """
+    with _dispatcher.__defaults__[1]:
+        dispatcher = _dispatcher.__defaults__[0].pop(_session_key(session), None)
+    if dispatcher and dispatcher.alive:
+        dispatcher.close()
+
+
+def _acks(_pool=[], _lock=Lock()):
+    """
+    The AckPool of this process, started when first needed.
+    """
+    with _lock:
+        if not _pool or not _pool[0].alive:
+            _pool[:] = [AckPool()]
+        return _pool[0]
+
+
+def _socket_path(session):
+    """
+    The path to the socket of a Kakoune session, or None if not found.
+    """
+    user = os.environ.get('USER', '')
+    candidates = []
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        candidates.append(os.path.join(os.environ['XDG_RUNTIME_DIR'], 'kakoune'))
+    tmpdir = os.environ.get('TMPDIR', '/tmp')
+    candidates.append(os.path.join(tmpdir, 'kakoune-' + user))
+    candidates.append(os.path.join('/tmp', 'kakoune', user))
+    for d in candidates:
+        path = os.path.join(d, session)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _command_message(msg):
+    u"""
+    Frame msg as a Command message of Kakoune's remote protocol.
+
+    The header is the message type and the total size, and the payload
+    is a length-prefixed string.
+
+    >>> m = _command_message(u'echo å')
+    >>> struct.unpack('=BII', m[:9])
+    (2, 16, 7)
+    >>> print(utils.decode(m[9:]))
+    echo å
+    """
+    payload = utils.encode(msg)
+    size = 1 + 4 + 4 + len(payload)
+    return struct.pack('=BII', 2, size, len(payload)) + payload
+
+
+def _client_quoted(msg):
+    r"""
+    Quote msg to be evaluated in a client.
+
+    A trailing backslash would escape the closing quote, so a newline
+    is added after it.
+
+    >>> print(_client_quoted("echo 'a `b`'\nexec x"))
+    'echo \'a `b`\'
+    exec x'
+    >>> print(_client_quoted('echo \\'))
+    'echo \
+    '
+    """
+    msg = utils.decode(msg)
+    if msg.endswith(u'\\'):
+        msg += u'\n'
+    return utils.single_quoted(msg)
+
+
+def _kak_p(session, msg):
+    """
+    Send msg to session using a `kak -p` process.
+    """
+    p = Popen(['kak', '-p', str(session).rstrip()], stdin=PIPE)
+    p.stdin.write(utils.encode(msg))
+    p.stdin.flush()
+    p.stdin.close()
+
+
 def _fifo_cleanup():
     """
     Writes _q to all open fifos created by _mkfifo.
@@ -482,8 +1068,15 @@ def _fifo_cleanup():
 
 
 def _debug(*xs):
-    if '-d' in sys.argv[1:]:
-        print(*xs, file=sys.stderr)
+    """
+    Log xs at debug level, formatting them only if that level is enabled.
+    """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(utils.join(six.text_type(x) for x in xs))
+
+
+if '-d' in sys.argv[1:] and not logging.getLogger().handlers:
+    utils.setup_logging(logging.DEBUG)
 
 
 #############################################################################
@@ -574,6 +1167,39 @@ def _test_remote_commands_async():
     pass
 
 
+def _test_wire_formats():
+    u"""
+    Fuzz the counted wire format against the escaped one, through bash.
+
+    >>> import random
+    >>> from subprocess import check_output
+    >>> random.seed(1)
+    >>> alphabet = [u'_', u's', u'u', u'n', u'S', u'\\n', u':', u'å', u' ', u'1']
+    >>> def fragment():
+    ...     return u''.join(random.choice(alphabet) for _ in range(random.randrange(12)))
+    >>> names = ['selection', 'bufname', 'client', 'args']
+    >>> for _ in range(40):
+    ...     env = dict(os.environ)
+    ...     env.update({'kak_' + n: utils.encode(fragment()) for n in names})
+    ...     args = [utils.encode(fragment()) for _ in range(random.randrange(4))]
+    ...     results = []
+    ...     for counted in [False, True]:
+    ...         splices, parse = Args.argsetup(names, {}, counted)
+    ...         script = Remote._msg(splices, '/dev/stdout', '1', counted)
+    ...         out = check_output(['bash', '-c', script, 'bash'] + args, env=env)
+    ...         if counted:
+    ...             header, _, msg = out.partition(b'\\n')
+    ...             assert int(header.split(b'#')[1]) == len(msg)
+    ...             results.append(parse(msg))
+    ...         else:
+    ...             results.append(parse(utils.decode(out).rstrip('\\n')[len('1:'):]))
+    ...     expected = {n: utils.decode(env['kak_' + n]) for n in names[:-1]}
+    ...     expected['args'] = tuple(utils.decode(a) for a in args)
+    ...     assert results[0] == results[1] == expected, (results, expected)
+    """
+    pass
+
+
 def _test_commands_with_params():
     u"""
     >>> kak = headless()
@@ -4,21 +4,30 @@ from __future__ import print_function
 from collections import defaultdict, OrderedDict
 from six.moves.queue import Queue
 from subprocess import Popen, PIPE
-from threading import Thread
+from threading import Thread, Lock
+import bisect
+import errno
 import pprint
 import itertools as it
+import io
 import json
+import logging
 import os
 import six
+import socket
+import stat
 import sys
 import tempfile
+import time
 import libkak
 import utils
 import functools
 import re
-from langserver import Langserver
+from langserver import Langserver, Servers, RequestCancelled, RequestTimedOut
 
 
+log = logging.getLogger('lspc')
+
 def edit_uri_select(uri, positions):
     filename = utils.uri_to_file(uri)
     if filename:
@@ -143,6 +152,169 @@ def complete_item(item, maxlen):
     )
 
 
+def word_start(contents, line, column):
+    u"""
+    The column where the word ending at (line, column) starts, the text
+    of the line before it and the word. Columns count bytes from 1, like
+    Kakoune's.
+
+    >>> word_start(u'a\\nx.få', 2, 6) == (3, u'x.', u'få')
+    True
+    """
+    text = contents.split('\n', line)[line - 1]
+    head = utils.decode(utils.encode(text)[:column - 1])
+    word = re.search(r'\w*$', head, re.UNICODE).group()
+    return column - len(utils.encode(word)), head[:len(head) - len(word)], word
+
+
+def word_range(contents, line, column):
+    u"""
+    The columns where the word at (line, column) starts and ends, or
+    (column, column) if the cursor is not on a word.
+
+    >>> word_range(u'få.bar', 1, 7)
+    (5, 8)
+    >>> word_range(u'få.bar', 1, 2)
+    (1, 4)
+    >>> word_range(u'få.bar', 1, 4)
+    (4, 4)
+    """
+    text = contents.split('\n', line)[line - 1]
+    tail = utils.decode(utils.encode(text)[column - 1:])
+    word = re.match(r'\w*', tail, re.UNICODE).group()
+    if not word:
+        return column, column
+    start, _, _ = word_start(contents, line, column)
+    return start, column + len(utils.encode(word))
+
+
+class CompletionCache(object):
+    """
+    The last completion result of each buffer, formatted once, so that
+    completing a longer prefix of the same word needs no request to the
+    language server.
+
+    Items whose filter text starts with the prefix are found by bisecting
+    the sorted keys, and those that contain it as a subsequence by
+    intersecting the items containing each of its characters. Case
+    sensitive prefix matches rank first, then other prefix matches, then
+    subsequence matches, each in the order of the server.
+
+    >>> cache = CompletionCache()
+    >>> items = [{'label': l} for l in ['ab', 'Abc', 'xaby', 'b']]
+    >>> [row[0] for row in cache.put('f', 1, 1, 'x = ', '', {'items': items})]
+    ['ab', 'Abc', 'xaby', 'b']
+    >>> [row[0] for row in cache.get('f', 1, 1, 'x = ', 'ab')]
+    ['ab', 'Abc', 'xaby']
+    >>> cache.get('f', 2, 1, 'x = ', 'ab') is None
+    True
+    >>> sorted(cache.stats.items())
+    [('hits', 1), ('misses', 1)]
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = Lock()
+
+    def put(self, buffile, line, start, head, prefix, result):
+        """
+        Format the completion result for the word at (line, start), and
+        cache it unless the server said it is incomplete.
+        """
+        if isinstance(result, list):
+            result = {'items': result}
+        items = result.get('items', [])
+        rows = list(complete_items(items))
+        if result.get('isIncomplete'):
+            self.entries.pop(buffile, None)
+            return rows
+        keys = [item.get('filterText') or item['label'] for item in items]
+        chars = defaultdict(set)
+        for i, key in enumerate(keys):
+            for c in key.lower():
+                chars[c].add(i)
+        self.entries[buffile] = {
+            'at': (line, start, head),
+            'prefix': prefix,
+            'rows': rows,
+            'keys': keys,
+            'sorted': sorted((key.lower(), i) for i, key in enumerate(keys)),
+            'chars': chars,
+        }
+        return rows
+
+    def get(self, buffile, line, start, head, prefix):
+        """
+        The cached rows for the word at (line, start) matching prefix,
+        or None if they are not known.
+        """
+        entry = self.entries.get(buffile)
+        hit = entry and entry['at'] == (line, start, head) and \
+            prefix.startswith(entry['prefix'])
+        with self.lock:
+            self.stats['hits' if hit else 'misses'] += 1
+        if not hit:
+            return None
+        keys, folded = entry['keys'], prefix.lower()
+        i = bisect.bisect_left(entry['sorted'], (folded,))
+        prefixed = []
+        for key, j in entry['sorted'][i:]:
+            if not key.startswith(folded):
+                break
+            prefixed.append(j)
+        prefixed.sort(key=lambda j: (not keys[j].startswith(prefix), j))
+        candidates = set(six.moves.range(len(keys)))
+        for c in set(folded):
+            candidates &= entry['chars'].get(c, set())
+        candidates.difference_update(prefixed)
+        subsequence = re.compile('.*?'.join(map(re.escape, folded)))
+        matching = [j for j in sorted(candidates) if subsequence.search(keys[j].lower())]
+        return [entry['rows'][j] for j in prefixed + matching]
+
+
+class Diagnostics(object):
+    """
+    The diagnostics of a buffer at a timestamp, by line and sorted by
+    position, built once per publishDiagnostics.
+
+    >>> diags = Diagnostics(1, [
+    ...     {'line': 4, 'col': 2, 'end': (4, 3), 'message': 'b'},
+    ...     {'line': 2, 'col': 5, 'end': (2, 6), 'message': 'a'},
+    ...     {'line': 4, 'col': 7, 'end': (4, 9), 'message': 'c'}])
+    >>> [d['message'] for d in diags.lines[4]]
+    ['b', 'c']
+    >>> diags.next((4, 3))['message'], diags.next((4, 7))['message']
+    ('c', 'a')
+    >>> diags.prev((4, 2))['message'], diags.prev((1, 1))['message']
+    ('a', 'c')
+    """
+
+    def __init__(self, timestamp, diagnostics):
+        self.timestamp = timestamp
+        self.lines = defaultdict(list)
+        self.sorted = sorted(diagnostics, key=lambda d: (d['line'], d['col']))
+        self.positions = [(d['line'], d['col']) for d in self.sorted]
+        for d in self.sorted:
+            self.lines[d['line']].append(d)
+
+    def next(self, pos):
+        """
+        The first diagnostic after pos, wrapping around to the first.
+        """
+        if self.sorted:
+            i = bisect.bisect_right(self.positions, pos)
+            return self.sorted[i % len(self.sorted)]
+
+    def prev(self, pos):
+        """
+        The last diagnostic before pos, wrapping around to the last.
+        """
+        if self.sorted:
+            i = bisect.bisect_left(self.positions, pos)
+            return self.sorted[i - 1]
+
+
 def pyls_signatureHelp(result, pos):
     sn = result['activeSignature']
     pn = result['signatures'][sn].get('activeParameter', -1)
@@ -176,11 +348,14 @@ def nice_sig(func_label, params, pn, pos):
 
 class Client:
 
-    def __init__(self):
+    def __init__(self, servers=None):
         self.langser = None
 
+        self.servers = servers or Servers()
         self.langservers = {}
         self.timestamps = {}
+        self.contents = {}
+        self.fingerprints = {}
         self.message_handlers = {}
 
         self.sig_help_chars = {}
@@ -190,70 +365,250 @@ class Client:
         self.original = {}
         self.chars_setup = set()
         self.session = None
+        self.batch = None
         self.mock = None
+        self.buffer_fifo = None
+        self.buffer = bytearray(64 * 1024)
         self.builders = {}
+        self.sync_lock = Lock()
+        self.scheduler = utils.Debouncer()
+        self.completions = CompletionCache()
+        self.results = utils.LRU(size=256, max_bytes=4 * 1024 * 1024)
+        self.stale = utils.LRU(size=256, max_bytes=4 * 1024 * 1024)
+        # seconds to wait for latency sensitive requests, the others
+        # (references, rename, executeCommand...) get a long deadline so
+        # that requests to a hung server are not kept forever
+        self.budgets = {
+            'textDocument/completion': 3.0,
+            'textDocument/hover': 2.0,
+            'textDocument/signatureHelp': 2.0,
+            'textDocument/definition': 5.0,
+        }
+        self.default_budget = 60.0
+        self.pending_diagnostics = {}
+        self.diagnostics_queries = {}
+        self.flags = {}
+        self.diagnostics_window = (0.02, 0.2)
+        self.diagnostics_stats = {'notifications': 0, 'renders': 0, 'unchanged': 0,
+                                  'added': 0, 'full': 0, 'seconds': 0.0}
+        self.diagnostics_stats_lock = Lock()
+
+    def count_diagnostics(self, key, n=1):
+        with self.diagnostics_stats_lock:
+            self.diagnostics_stats[key] += n
+
+    def render_diagnostics(self, filetype, buffile, clientp, params, timestamp, disabled):
+        """
+        Index the diagnostics and send Kakoune the flags that changed.
+
+        >>> client, sent = Client(), []
+        >>> client.batch = libkak.Batcher(sent.append, window=60)
+        >>> def diag(line, severity):
+        ...     pos = {'line': line, 'character': 0}
+        ...     return {'range': {'start': pos, 'end': pos}, 'severity': severity,
+        ...             'message': 'm'}
+        >>> def render(timestamp, *diags):
+        ...     client.render_diagnostics('python', '/a.py', None,
+        ...                               {'diagnostics': list(diags)}, timestamp, '')
+        ...     client.batch.flush()
+        ...     for msg in sent:
+        ...         print(msg.replace(u'\u2022', '*'))
+        ...     del sent[:]
+        >>> render(5, diag(0, 1))
+        try %{add-highlighter window/ flag_lines default lsp_flags}
+        set buffer=/a.py lsp_flags '5:1|  :1|{red}* '
+
+        Diagnostics added for the same timestamp are appended, without it:
+
+        >>> render(5, diag(0, 1), diag(2, 2))
+        set -add buffer=/a.py lsp_flags '3|{yellow}* '
+        >>> render(5, diag(0, 1), diag(2, 2))
+        >>> render(6, diag(2, 2))
+        try %{add-highlighter window/ flag_lines default lsp_flags}
+        set buffer=/a.py lsp_flags '6:1|  :3|{yellow}* '
+        >>> [client.diagnostics_stats[k] for k in ['full', 'added', 'unchanged']]
+        [2, 1, 1]
+        """
+        diagnostics = []
+        flags = ['1|  ']
+        from_severity = [
+            u'',
+            u'{red}\u2022 ',
+            u'{yellow}\u2022 ',
+            u'{blue}\u2022 ',
+            u'{green}\u2022 '
+        ]
+        for diag in params['diagnostics']:
+            if disabled and re.match(disabled, diag['message']):
+                continue
+            (line0, col0), end = utils.range(diag['range'])
+            flags.append(str(line0) + '|' +
+                         from_severity[diag.get('severity', 1)])
+            diagnostics.append({
+                'line': line0,
+                'col': col0,
+                'end': end,
+                'message': diag['message']
+            })
+        self.diagnostics[filetype, buffile] = Diagnostics(timestamp, diagnostics)
+        old_timestamp, old_flags = self.flags.get(buffile, (None, []))
+        self.flags[buffile] = (timestamp, flags)
+        if old_timestamp == timestamp:
+            if old_flags == flags:
+                self.count_diagnostics('unchanged')
+                return
+            if flags[:len(old_flags)] == old_flags:
+                self.count_diagnostics('added')
+                # -add appends line|flag elements, the timestamp stays
+                msg = 'set -add buffer=' + buffile + ' lsp_flags '
+                msg += utils.single_quoted(':'.join(flags[len(old_flags):]))
+                self.batch(msg, clientp)
+                return
+        self.count_diagnostics('full')
+        # todo: Set for the other buffers too (but they need to be opened)
+        msg = 'try %{add-highlighter window/ flag_lines default lsp_flags}\n'
+        msg += 'set buffer=' + buffile + ' lsp_flags '
+        msg += utils.single_quoted(':'.join([str(timestamp)] + flags))
+        self.batch(msg, clientp, key=('lsp_flags', buffile))
 
     def push_message(self, filetype):
         def k(method, params):
             self.message_handlers.get(method, utils.noop)(filetype, params)
         return k
 
-    def make_sync(self, method, make_params):
+    def read_buffer(self, reply, client):
+        """
+        A memoryview of the utf-8 contents of the buffer of client,
+        valid until the next call.
+
+        Kakoune writes the buffer to a fifo, which is read into a buffer
+        that is reused between calls, so no file is written to disk.
+        Should be called with sync_lock held.
+        """
+        if not self.buffer_fifo:
+            # not made by libkak._mkfifo, as nothing reads it between
+            # calls for libkak._fifo_cleanup to write _q to
+            self.buffer_fifo = os.path.join(tempfile.mkdtemp(), 'fifo')
+            os.mkfifo(self.buffer_fifo)
+        # Kakoune buffers end with a newline, so reading nothing
+        # means that the write failed.
+        libkak.pipe(reply, """
+            try %{{ eval -no-hooks 'write {0}' }} catch %{{ nop %sh{{ : > {0} }} }}
+        """.format(self.buffer_fifo), client=client)
+        with io.open(self.buffer_fifo, 'rb', buffering=0) as fifo:
+            n = utils.read_into(fifo, self.buffer)
+        if not n:
+            raise RuntimeError('Could not write the buffer of {}'.format(client))
+        log.debug('finished reading buffer from fifo')
+        return memoryview(self.buffer)[:n]
+
+    def make_sync(self, method, make_params, cancel=False, lookup=None, cache_key=None):
+
+        if make_params:
+            make_params = utils.kwcaller(make_params)
+        if lookup:
+            lookup = utils.kwcaller(lookup)
+        if cache_key:
+            cache_key = utils.kwcaller(cache_key)
 
         def sync(d, line, column, buffile, filetype, timestamp, pwd, cmd, client, reply):
 
             d['pos'] = {'line': line - 1, 'character': column - 1}
-            d['uri'] = uri = 'file://' + six.moves.urllib.parse.quote(buffile)
+            d['uri'] = uri = utils.file_to_uri(buffile)
 
-            if cmd in self.langservers:
-                print(filetype + ' already spawned')
-            else:
-                push = self.push_message(filetype)
-                self.langservers[cmd] = Langserver(pwd, cmd, push, self.mock)
+            root = utils.project_root(os.path.dirname(buffile)) or pwd
 
-            if not client:
-                print("Client was empty when syncing")
+            with self.sync_lock:
+                if (cmd, root) in self.langservers:
+                    log.debug('%s already spawned for %s', filetype, root)
+                else:
+                    push = self.push_message(filetype)
+                    self.langservers[cmd, root] = self.servers.get(cmd, root, str(self.session),
+                                                                   push, self.mock)
 
-            d['langserver'] = langserver = self.langservers[cmd]
+                if not client:
+                    log.warning('Client was empty when syncing')
 
-            old_timestamp = self.timestamps.get((filetype, buffile))
-            if old_timestamp == timestamp and not d['force']:
-                print('no need to send update')
-                reply('')
-            else:
-                self.timestamps[(filetype, buffile)] = timestamp
-                with tempfile.NamedTemporaryFile() as tmp:
-                    write = "eval -no-hooks 'write {}'".format(tmp.name)
-                    libkak.pipe(reply, write, client=client, sync=True)
-                    print('finished writing to tempfile')
-                    contents = open(tmp.name, 'r').read()
-                self.client_editing[filetype, buffile] = client
-                if old_timestamp is None:
-                    langserver.call('textDocument/didOpen', {
-                        'textDocument': {
-                            'uri': uri,
-                            'version': timestamp,
-                            'languageId': filetype,
-                            'text': contents
-                        }
-                    })()
+                d['langserver'] = langserver = self.langservers[cmd, root]
+
+                old_timestamp = self.timestamps.get((filetype, buffile))
+                if old_timestamp == timestamp and not d['force'] and \
+                        langserver.opened.get(uri) == str(self.session):
+                    log.debug('no need to send update')
+                    reply('')
                 else:
-                    langserver.call('textDocument/didChange', {
-                        'textDocument': {
-                            'uri': uri,
-                            'version': timestamp
-                        },
-                        'contentChanges': [{'text': contents}]
-                    })()
-                print('sync: waiting for didChange reply...')
-                print('sync: got didChange reply...')
+                    view = self.read_buffer(reply, client)
+                    fingerprint = utils.fingerprint(view)
+                    if old_timestamp != timestamp:
+                        self.results.evict(lambda key: key[0] == uri)
+                    self.timestamps[(filetype, buffile)] = timestamp
+                    self.client_editing[filetype, buffile] = client
+                    # the server may be shared with other sessions
+                    synced_by = langserver.opened.get(uri)
+                    langserver.opened[uri] = str(self.session)
+                    if (synced_by == str(self.session) and
+                            self.fingerprints.get((filetype, buffile)) == fingerprint):
+                        log.debug('contents unchanged, no need to send update')
+                    else:
+                        self.fingerprints[(filetype, buffile)] = fingerprint
+                        contents = utils.decode_view(view)
+                        old_contents = self.contents.get((filetype, buffile))
+                        if synced_by != str(self.session):
+                            old_contents = None
+                        self.contents[(filetype, buffile)] = contents
+                        if synced_by is None:
+                            langserver.call('textDocument/didOpen', {
+                                'textDocument': {
+                                    'uri': uri,
+                                    'version': langserver.next_version(uri),
+                                    'languageId': filetype,
+                                    'text': contents
+                                }
+                            })()
+                        else:
+                            if old_contents is not None and langserver.sync_kind() == 2:
+                                change = utils.text_change(old_contents, contents)
+                                changes = [change] if change else []
+                            else:
+                                changes = [{'text': contents}]
+                            langserver.call('textDocument/didChange', {
+                                'textDocument': {
+                                    'uri': uri,
+                                    'version': langserver.next_version(uri)
+                                },
+                                'contentChanges': changes
+                            })()
+                    log.debug('sync: done')
+
+            if method and lookup:
+                result = lookup(d)
+                if result is not None:
+                    log.debug('%s answered locally', method)
+                    return {'result': result}
 
             if method:
-                print(method, 'calling langserver')
+                key = cache_key(d) if cache_key else None
+                if key is not None:
+                    key = tuple(key)
+                    result = self.results.get((uri, timestamp, method) + key, self.results)
+                    if result is not self.results:
+                        log.debug('%s answered from cache', method)
+                        return {'result': result}
+                log.debug('%s calling langserver', method)
                 q = Queue()
-                langserver.call(method, utils.safe_kwcall(
-                    make_params, d))(q.put)
-                return q.get()
+                supersede = (buffile, method) if cancel else None
+                budget = self.budgets.get(method, self.default_budget)
+                langserver.call(method, make_params(d), supersede, budget)(q.put)
+                msg = q.get()
+                if key is not None and 'result' in msg:
+                    self.results.put((uri, timestamp, method) + key, msg['result'])
+                    self.stale.put((uri, method) + key, msg['result'])
+                elif key is not None and msg.get('error', {}).get('code') == RequestTimedOut:
+                    result = self.stale.get((uri, method) + key, self.stale)
+                    if result is not self.stale:
+                        log.debug('%s timed out, answering with a stale result', method)
+                        return {'result': result, 'stale': True}
+                return msg
             else:
                 return {'result': None}
 
@@ -269,13 +624,15 @@ class Client:
             return f
         return decorator
 
-    def handler(self, method=None, make_params=None, params='0', enum=None, force=False, hidden=False):
+    def handler(self, method=None, make_params=None, params='0', enum=None, force=False, hidden=False,
+                supersede=False, lookup=None, cache_key=None):
         def decorate(f):
             def builder():
                 self.original[f.__name__] = f
 
                 r = libkak.Remote(self.session)
-                r.command(r, params=params, enum=enum, sync_setup=True, hidden=hidden)
+                r.command(r, params=params, enum=enum, sync_setup=True, hidden=hidden,
+                          supersede=supersede)
                 r_pre = r.pre
                 r.pre = lambda f: r_pre(f) + '''
                         [[ -z $kak_opt_filetype ]] && exit
@@ -291,27 +648,38 @@ class Client:
                         done <<< "$kak_opt_lsp_servers"''' + r.post
                 r.setup_reply_channel(r)
                 r.arg_config['cmd'] = ('cmd', libkak.Args.string)
-                sync = self.make_sync(method, make_params)
+                sync = self.make_sync(method, make_params, cancel=supersede, lookup=lookup,
+                                      cache_key=cache_key)
                 r.puns = False
                 r.argnames = utils.argnames(sync) + utils.argnames(f)
+                call_sync = utils.kwcaller(sync)
+                call_f = utils.kwcaller(f)
 
                 @functools.wraps(f)
                 def k(d):
                     try:
                         d['d'] = d
                         d['force'] = force
-                        # print('handler calls sync', pprint.pformat(d))
-                        msg = utils.safe_kwcall(sync, d)
-                        # print('sync called', status, result, pprint.pformat(d))
+                        msg = call_sync(d)
                         if 'result' in msg:
                             d['result'] = msg['result']
-                            print('Calling', f.__name__, pprint.pformat(d)[:500])
-                            msg = utils.safe_kwcall(f, d)
+                            stale = msg.get('stale')
+                            log.debug('Calling %s %s', f.__name__,
+                                      utils.lazy(lambda: pprint.pformat(d)[:500]))
+                            msg = call_f(d)
+                            if msg and stale:
+                                msg += '\necho -markup "{yellow}Stale result: ' \
+                                       'the language server timed out"'
                             if msg:
-                                print('Answer from', f.__name__, ':', msg)
-                                d['pipe'](msg)
+                                log.debug('Answer from %s: %s', f.__name__, msg)
+                                self.batch(msg, d['client'])
+                        elif msg.get('error', {}).get('code') == RequestCancelled:
+                            log.debug('%s superseded', f.__name__)
+                        elif msg.get('error', {}).get('code') == RequestTimedOut:
+                            log.warning('%s timed out', f.__name__)
+                            d['pipe']('echo -markup "{red}The language server timed out"')
                         else:
-                            print('Error: ', msg)
+                            log.warning('Error: %s', msg)
                             d['pipe']('''
                             echo -debug When handling {}:
                             echo -debug {}
@@ -321,7 +689,7 @@ class Client:
                     except:
                         import traceback
                         msg = f.__name__ + ' ' + traceback.format_exc()
-                        print(msg)
+                        log.error('%s', msg)
                         d['pipe']('''
                         echo -debug When handling {}:
                         echo -debug {}
@@ -334,41 +702,102 @@ class Client:
         return decorate
 
     def pipe(self, msg, client=None, sync=False):
-        libkak.pipe(self.session, msg, client, sync)
+        if sync:
+            self.batch.flush()
+            libkak.pipe(self.session, msg, client, sync)
+        else:
+            self.batch(msg, client)
+
+    def detach(self):
+        """
+        Release the language servers of the session, and stop the
+        Remotes, scheduler and batcher serving it.
+        """
+        self.servers.release(str(self.session))
+        self.scheduler.stop()
+        self.batch.close()
+        libkak.disconnect(self.session)
+        with self.sync_lock:
+            if self.buffer_fifo:
+                os.remove(self.buffer_fifo)
+                os.rmdir(os.path.dirname(self.buffer_fifo))
+                self.buffer_fifo = None
 
     def main(self, session, mock={}, messages=""):
-        self.session = session
+        self.session = libkak.connect(session)
+        self.batch = libkak.Batcher(self.session)
         self.mock = mock
 
         for k, builder in self.builders.items():
             builder()
 
-        libkak.pipe(session, """#kak
+        r = libkak.Remote.command(self.session, params='1..2',
+                                  enum=[('lsp-complete', 'lsp-signature-help'), ('trigger',)])
+        r.arg_config['delay'] = ('kak_opt_lsp_schedule_delay', int)
+        r.arg_config['max_wait'] = ('kak_opt_lsp_schedule_max_wait', int)
+
+        @r
+        def lsp_schedule(arg1, arg2, client, delay, max_wait):
+            """
+            Run a command in this client once a burst of calls to
+            lsp-schedule for it has settled: lsp_schedule_delay ms after
+            the last call, or at most lsp_schedule_max_wait ms after the
+            first. Calls with a second argument 'trigger' take priority
+            over those without, which are meant for idle hooks:
+
+            hook -group lsp global InsertIdle .* %{
+                lsp-schedule lsp-signature-help
+            }
+            """
+            self.scheduler((client, arg1), lambda: self.pipe(arg1, client),
+                           delay / 1000.0, max_wait / 1000.0, priority=arg2 == 'trigger')
+
+        @libkak.Remote.command(self.session, hidden=True)
+        def lsp_detach():
+            """
+            Stop using the language servers of this session.
+            """
+            self.detach()
+
+        libkak.pipe(self.session, """#kak
         remove-hooks global lsp
         try %{declare-option str lsp_servers}
         try %{declare-option str lsp_complete_chars}
         try %{declare-option str lsp_signature_help_chars}
         try %{declare-option completions lsp_completions}
         try %{declare-option line-specs lsp_flags}
+        try %{declare-option int lsp_schedule_delay 50}
+        try %{declare-option int lsp_schedule_max_wait 200}
 
         hook -group lsp global InsertChar .* %{
             try %{
                 exec -no-hooks -draft <esc><space>h<a-k>[ %opt{lsp_complete_chars} ]<ret>
-                lsp-complete
+                lsp-schedule lsp-complete trigger
             }
             try %{
                 exec -no-hooks -draft <esc><space>h<a-k>[ %opt{lsp_signature_help_chars} ]<ret>
-                lsp-signature-help
+                lsp-schedule lsp-signature-help trigger
             }
         }
 
         # hook -group lsp global WinDisplay .* lsp-sync
         hook -group lsp global BufWritePost .* lsp-send-did-save
         hook -group lsp global BufClose .* lsp-buffer-deleted
+        hook -group lsp global KakEnd .* lsp-detach
         """ + messages)
 
-def makeClient():
-    client = Client()
+def makeClient(servers=None):
+    client = Client(servers)
+
+    # Keys for results cached until the buffer changes
+
+    def word_key(line, column, buffile, filetype):
+        contents = client.contents.get((filetype, buffile))
+        if contents is not None:
+            return (line,) + word_range(contents, line, column)
+
+    def position_key(line, column):
+        return (line, column)
 
     # Handlers
 
@@ -398,7 +827,7 @@ def makeClient():
 
         if 'message' in params:
             libkak._debug('Adding debug print', params)
-            libkak.pipe(client.session, 'echo -debug ' + utils.single_quote_escape(params['message']))
+            client.pipe('echo -debug ' + utils.single_quote_escape(params['message']))
 
         if 'uri' not in params:
             return
@@ -407,47 +836,52 @@ def makeClient():
         if not clientp:
             return
 
-        libkak.pipe(client.session, 'echo ' + utils.single_quote_escape(params['message']), client=clientp)
+        client.pipe('echo ' + utils.single_quote_escape(params['message']), client=clientp)
+
+    def diagnostics_query(filetype):
+        """
+        The hidden command that reports the timestamp of a buffer and the
+        diagnostics disabled for filetype, defined once per filetype.
+        """
+        if filetype in client.diagnostics_queries:
+            return client.diagnostics_queries[filetype]
+        r = libkak.Remote.command(client.session, hidden=True, sync_setup=True)
+        r.arg_config['disabled'] = (
+            'kak_opt_lsp_' + filetype + '_disabled_diagnostics',
+            libkak.Args.string)
+
+        def query(timestamp, disabled, buffile):
+            pending = client.pending_diagnostics.pop(buffile, None)
+            if not pending:
+                return
+            start = time.time()
+            client.render_diagnostics(filetype, buffile, pending[0], pending[1],
+                                      timestamp, disabled)
+            client.count_diagnostics('renders')
+            client.count_diagnostics('seconds', time.time() - start)
+        query.__name__ = 'lsp_diagnostics_query_' + re.sub(r'\W', '_', filetype)
+        r(query)
+        name = client.diagnostics_queries[filetype] = query.__name__.replace('_', '-')
+        return name
 
     @client.message_handler
     def textDocument_publishDiagnostics(filetype, params):
+        """
+        Render the latest diagnostics of each buffer once a burst of
+        notifications for it has settled.
+        """
         buffile = utils.uri_to_file(params['uri'])
         clientp = client.client_editing.get((filetype, buffile))
         if not clientp:
             return
-        r = libkak.Remote.onclient(client.session, clientp, sync=False)
-        r.arg_config['disabled'] = (
-            'kak_opt_lsp_' + filetype + '_disabled_diagnostics',
-            libkak.Args.string)
+        client.count_diagnostics('notifications')
+        client.pending_diagnostics[buffile] = (clientp, params)
 
-        @r
-        def _(timestamp, pipe, disabled):
-            client.diagnostics[filetype, buffile] = defaultdict(list)
-            client.diagnostics[filetype, buffile]['timestamp'] = timestamp
-            flags = [str(timestamp), '1|  ']
-            from_severity = [
-                u'',
-                u'{red}\u2022 ',
-                u'{yellow}\u2022 ',
-                u'{blue}\u2022 ',
-                u'{green}\u2022 '
-            ]
-            for diag in params['diagnostics']:
-                if disabled and re.match(disabled, diag['message']):
-                    continue
-                (line0, col0), end = utils.range(diag['range'])
-                flags.append(str(line0) + '|' +
-                             from_severity[diag.get('severity', 1)])
-                client.diagnostics[filetype, buffile][line0].append({
-                    'col': col0,
-                    'end': end,
-                    'message': diag['message']
-                })
-            # todo: Set for the other buffers too (but they need to be opened)
-            msg = 'try %{add-highlighter window/ flag_lines default lsp_flags}\n'
-            msg += 'set buffer=' + buffile + ' lsp_flags '
-            msg += utils.single_quoted(':'.join(flags))
-            pipe(msg)
+        def query():
+            name = diagnostics_query(filetype)
+            client.pipe('eval -buffer ' + utils.single_quoted(buffile) + ' ' + name)
+        delay, max_wait = client.diagnostics_window
+        client.scheduler(('diagnostics', buffile), query, delay, max_wait)
 
     @client.handler(force=True)
     def lsp_sync(buffile, filetype):
@@ -480,6 +914,22 @@ def makeClient():
             msg += s('lsp_complete_chars', client.complete_chars.get(filetype))
         return msg
 
+    @client.handler()
+    def lsp_stats():
+        """
+        Write statistics about the language client to the debug buffer
+        """
+        stats = {'batch': client.batch.stats, 'handlers': libkak.pool.stats(),
+                 'scheduler': client.scheduler.stats,
+                 'completions': client.completions.stats,
+                 'results': client.results.stats,
+                 'stale': client.stale.stats,
+                 'diagnostics': client.diagnostics_stats,
+                 'langservers': {' '.join(key): langserver.stats
+                                 for key, langserver in six.iteritems(client.langservers)},
+                 'servers': client.servers.stats()}
+        return 'echo -debug ' + utils.single_quoted(pprint.pformat(stats))
+
     @client.handler(hidden=True)
     def lsp_send_did_save(langserver, uri):
         """
@@ -498,12 +948,18 @@ def makeClient():
         """
         client.client_editing[filetype, buffile] = None
         client.timestamps[(filetype, buffile)] = None
+        client.contents.pop((filetype, buffile), None)
+        client.fingerprints.pop((filetype, buffile), None)
+        client.completions.entries.pop(buffile, None)
+        uri = utils.file_to_uri(buffile)
+        client.results.evict(lambda key: key[0] == uri)
+        client.stale.evict(lambda key: key[0] == uri)
 
     @client.handler('textDocument/signatureHelp',
              lambda pos, uri: {
                  'textDocument': {'uri': uri},
                  'position': pos},
-             params='0..1', enum=[somewhere])
+             params='0..1', enum=[somewhere], supersede=True, cache_key=position_key)
     def lsp_signature_help(arg1, pos, uri, result):
         """
         Write signature help by the cursor, info, echo or docsclient.
@@ -527,24 +983,46 @@ def makeClient():
                     label = str(result)
         return info_somewhere(label, pos, where)
 
+    def complete_lookup(line, column, buffile, filetype):
+        contents = client.contents.get((filetype, buffile))
+        if contents is None:
+            return None
+        start, head, word = word_start(contents, line, column)
+        rows = client.completions.get(buffile, line, start, head, word)
+        if rows is not None:
+            return {'rows': rows}
+
     @client.handler('textDocument/completion',
              lambda pos, uri: {
                  'textDocument': {'uri': uri},
-                 'position': pos})
-    def lsp_complete(line, column, timestamp, buffile, completers, result):
+                 'position': pos},
+             supersede=True, lookup=complete_lookup)
+    def lsp_complete(line, column, timestamp, buffile, filetype, completers, result):
         """
-        Complete at the main cursor.
+        Complete the word at the main cursor.
 
         Example to force completion at word begin:
 
         map global insert <a-c> '<a-;>:eval -draft %(exec b; lsp-complete)<ret>'
 
+        When the word is a longer prefix of the last completed one, the
+        last result is filtered without asking the language server, so
+        this is cheap to hook to InsertIdle:
+
+        hook -group lsp global InsertIdle .* %{
+            lsp-schedule lsp-complete
+        }
+
         The option lsp_completions is prepended to the completers if missing.
         """
         if not result:
             return
-        cs = complete_items(result.get('items', []))
-        s = utils.single_quoted(libkak.complete(line, column, timestamp, cs))
+        start, head, word = word_start(client.contents[filetype, buffile], line, column)
+        if isinstance(result, dict) and 'rows' in result:
+            cs = result['rows']
+        else:
+            cs = client.completions.put(buffile, line, start, head, word, result)
+        s = utils.single_quoted(libkak.complete(line, start, timestamp, cs))
         setup = ''
         opt = 'option=lsp_completions'
         if opt not in completers:
@@ -566,21 +1044,17 @@ def makeClient():
         }
         """
         where = arg1 or 'cursor'
-        diag = client.diagnostics.get((filetype, buffile), {})
-        if line in diag and diag[line]:
-            min_col = 98765
-            msgs = []
-            for d in diag[line]:
-                if d['col'] < min_col:
-                    min_col = d['col']
-                msgs.append(d['message'])
+        diag = client.diagnostics.get((filetype, buffile))
+        if diag and diag.lines.get(line):
+            msgs = [d['message'] for d in diag.lines[line]]
+            min_col = diag.lines[line][0]['col']
             pos = {'line': line - 1, 'character': min_col - 1}
             return info_somewhere('\n'.join(msgs), pos, where)
 
     @client.handler(params='0..2', enum=[('next', 'prev'), somewhere + ['none']])
-    def lsp_diagnostics_jump(arg1, arg2, timestamp, line, buffile, filetype, pipe):
+    def lsp_diagnostics_jump(arg1, arg2, timestamp, selection_desc, buffile, filetype, pipe):
         """
-        Jump to next or prev diagnostic (relative to the main cursor line)
+        Jump to next or prev diagnostic (relative to the main selection)
 
         Example configuration:
 
@@ -593,38 +1067,16 @@ def makeClient():
         if not diag:
             libkak._debug('no diagnostics')
             return
-        if timestamp != diag.get('timestamp'):
+        if timestamp != diag.timestamp:
             pipe('lsp-sync')
-        next_line = None
-        first_line = None
-        last_line = None
-        for other_line in six.iterkeys(diag):
-            if other_line == 'timestamp':
-                continue
-            if not first_line or other_line < first_line:
-                first_line = other_line
-            if not last_line or other_line > last_line:
-                last_line = other_line
-            if next_line:
-                if direction == 'prev':
-                    cmp = next_line < other_line < line
-                else:
-                    cmp = next_line > other_line > line
-            else:
-                if direction == 'prev':
-                    cmp = other_line < line
-                else:
-                    cmp = other_line > line
-            if cmp:
-                next_line = other_line
-        if not next_line and direction == 'prev':
-            next_line = last_line
-        if not next_line and direction == 'next':
-            next_line = first_line
-        if next_line:
-            y = next_line
-            x = diag[y][0]['col']
-            end = diag[y][0]['end']
+        if direction == 'prev':
+            d = diag.prev(min(selection_desc))
+        else:
+            d = diag.next(max(selection_desc))
+        if d:
+            y = d['line']
+            x = d['col']
+            end = d['end']
             msg = libkak.select([((y, x), end)])
             if where == 'none':
                 return msg
@@ -636,7 +1088,7 @@ def makeClient():
              lambda pos, uri: {
                  'textDocument': {'uri': uri},
                  'position': pos},
-             params='0..1', enum=[somewhere])
+             params='0..1', enum=[somewhere], supersede=True, cache_key=word_key)
     def lsp_hover(arg1, pos, uri, result):
         """
         Display hover information somewhere ('cursor', 'info', 'echo' or
@@ -702,7 +1154,8 @@ def makeClient():
     @client.handler('textDocument/definition',
              lambda pos, uri: {
                  'textDocument': {'uri': uri},
-                 'position': pos})
+                 'position': pos},
+             cache_key=word_key)
     def lsp_goto_definition(result):
         """
         Go to the definition of the identifier at the main cursor.
@@ -736,5 +1189,120 @@ def makeClient():
 
     return client
 
+def daemon_path():
+    """
+    The path of the socket the lspc daemon of this user listens on,
+    in $XDG_RUNTIME_DIR if it is set.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'lspc', 'daemon')
+    return os.path.join(tempfile.gettempdir(), 'lspc-' + str(os.getuid()), 'daemon')
+
+
+def private_dir(path):
+    """
+    Create the directory path, accessible only to this user, or check
+    that it already is. Raises OSError if it is not.
+
+    >>> import shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> private_dir(os.path.join(tmp, 'lspc'))
+    >>> os.chmod(os.path.join(tmp, 'lspc'), 0o777)
+    >>> try:
+    ...     private_dir(os.path.join(tmp, 'lspc'))
+    ... except OSError as e:
+    ...     print(e.strerror)
+    Not a private directory
+    >>> shutil.rmtree(tmp)
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(errno.EPERM, 'Not a private directory', path)
+
+
+def serve(path, idle=300, setup=utils.noop):
+    """
+    Serve the Kakoune sessions that attach on the socket at path, sharing
+    the language servers between them. Servers no session uses are shut
+    down after idle seconds. Each attach is handled in a thread of its
+    own, so that a session that hangs does not keep others out.
+    """
+    servers = Servers(idle=idle)
+    private_dir(os.path.dirname(path))
+    # a socket left behind by an earlier daemon
+    if os.path.exists(path) and stat.S_ISSOCK(os.lstat(path).st_mode):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(8)
+    log.info('daemon listening on %s', path)
+
+    def attach_session(conn):
+        try:
+            session = utils.decode(conn.makefile('rb').readline()).strip()
+            log.info('attaching session %s', session)
+            client = makeClient(servers)
+            setup(client)
+            client.main(session)
+            conn.sendall(b'ok\n')
+        except Exception:
+            log.exception('could not attach session')
+        finally:
+            conn.close()
+
+    while True:
+        conn, _ = sock.accept()
+        t = Thread(target=attach_session, args=(conn,))
+        t.daemon = True
+        t.start()
+
+
+def attach(path, session, timeout=10):
+    """
+    Attach session to the daemon listening at path. Returns False if no
+    daemon is listening there, or if it has not attached the session
+    within timeout seconds.
+    """
+    try:
+        private_dir(os.path.dirname(path))
+    except OSError as e:
+        log.warning('not attaching to the daemon: %s', e)
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(utils.encode(session + '\n'))
+        return sock.makefile('rb').readline() == b'ok\n'
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
 if __name__ == '__main__':
-    makeClient().main(sys.argv[1])
+    # usage: lspc.py (SESSION | --daemon) [-d] [--log FILE] [--idle SECONDS]
+    #                [--cache-size N] [--cache-bytes N]
+    args = sys.argv[1:]
+    logfile = args[args.index('--log') + 1] if '--log' in args else None
+    utils.setup_logging(logging.DEBUG if '-d' in args else logging.INFO, logfile)
+
+    def setup(client):
+        if '--cache-size' in args:
+            client.results.size = int(args[args.index('--cache-size') + 1])
+        if '--cache-bytes' in args:
+            client.results.max_bytes = int(args[args.index('--cache-bytes') + 1])
+
+    if '--daemon' in args:
+        idle = int(args[args.index('--idle') + 1]) if '--idle' in args else 300
+        serve(daemon_path(), idle, setup)
+    elif not attach(daemon_path(), args[0]):
+        client = makeClient()
+        setup(client)
+        client.main(args[0])
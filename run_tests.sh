@@ -1,4 +1,4 @@
-python2 -m doctest utils.py libkak.py lspc.py && \
-python -m doctest utils.py libkak.py lspc.py && \
+python2 -m doctest utils.py libkak.py langserver.py lspc.py && \
+python -m doctest utils.py libkak.py langserver.py lspc.py aio.py && \
 python2 test/mock_ls.py && \
 python test/mock_ls.py
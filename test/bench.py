@@ -0,0 +1,272 @@
+"""
+Benchmarks for libkak and lspc.
+
+Run all of them from the repository root:
+
+    python test/bench.py
+
+or only some of them by name:
+
+    python test/bench.py client_pipe
+"""
+
+from __future__ import print_function
+import sys
+import os
+sys.path.append(os.getcwd())
+from collections import OrderedDict
+import re
+import subprocess
+import tempfile
+import timeit
+import libkak
+import utils
+
+
+benchmarks = OrderedDict()
+
+
+def benchmark(f):
+    benchmarks[f.__name__] = f
+    return f
+
+
+def per_call(f, number):
+    """
+    Seconds per call of f, best of three runs.
+    """
+    return min(timeit.repeat(f, number=number, repeat=3)) / number
+
+
+def report(name, seconds, extra=''):
+    print('{:<40} {:>12.1f} us {}'.format(name, seconds * 1e6, extra))
+
+
+def payload(size):
+    """
+    A message of about size bytes with quotes, backticks and newlines.
+    """
+    chunk = u"echo 'it''s `here`' \\ %{x} \"y\"\n"
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+
+@benchmark
+def client_pipe():
+    """
+    Client-targeted pipe: temp file and shell (old) vs inline quoting (new).
+
+    The old path is measured including the `sh -c 'cat; rm'` that Kakoune
+    used to run. The new path is measured up to the message being ready
+    to be sent.
+    """
+    for size in [100, 10 * 1000, 100 * 1000, 1000 * 1000]:
+        msg = payload(size)
+
+        def old():
+            name = tempfile.mktemp()
+            with open(name, 'wb') as tmp:
+                tmp.write(utils.encode(msg))
+            subprocess.check_output(['sh', '-c', 'cat {}; rm {}'.format(name, name)])
+
+        def new():
+            utils.encode(u'eval -client unnamed0 ' + libkak._client_quoted(msg))
+
+        report('client_pipe old {} B'.format(size), per_call(old, 20))
+        report('client_pipe new {} B'.format(size), per_call(new, 20))
+
+
+@benchmark
+def wire_formats():
+    """
+    A call with a large kak_selection: encoding in bash and parsing in
+    Python, for the escaped and the counted wire formats.
+
+    Values are passed in the environment, which caps them at 128 kB.
+    """
+    for size in [1000, 10 * 1000, 100 * 1000]:
+        env = dict(os.environ, kak_client='unnamed0',
+                   kak_selection=utils.encode(payload(size).replace(' ', '_')))
+        for counted in [False, True]:
+            name = 'counted' if counted else 'escaped'
+            splices, parse = libkak.Args.argsetup(['client', 'selection'], {}, counted)
+            script = libkak.Remote._msg(splices, '/dev/stdout', '1', counted)
+            out = subprocess.check_output(['bash', '-c', script], env=env)
+            if counted:
+                msg = out.partition(b'\n')[2]
+            else:
+                msg = utils.decode(out).rstrip('\n')[len('1:'):]
+
+            def shell():
+                subprocess.check_output(['bash', '-c', script], env=env)
+
+            report('wire_formats {} shell {} B'.format(name, size), per_call(shell, 1))
+            report('wire_formats {} parse {} B'.format(name, size),
+                   per_call(lambda: parse(msg), 20))
+
+
+def regex_listof(p):
+    """
+    Args.listof as it was before the scanner, for comparison.
+    """
+    def rmlastcolon(s):
+        if s and s[-1] == ':':
+            return s[:-1]
+        else:
+            return s
+
+    def inner(s):
+        ms = [m.group(0)
+              for m in re.finditer(r'(.*?(?<!\\)(\\\\)*:|.+)', s)]
+        ms = [m if i == len(ms) - 1 else rmlastcolon(m)
+              for i, m in enumerate(ms)]
+        return [p(re.sub(r'\\(.)', r'\g<1>', x)) for x in ms]
+    return inner
+
+
+@benchmark
+def listof():
+    """
+    Parsing selections_desc and selections lists: the old regex based
+    parser vs the scanner, building a list and consuming it lazily.
+    """
+    for n in [10, 1000, 100 * 1000]:
+        descs = ':'.join('{}.1,{}.12'.format(i, i) for i in range(1, n + 1))
+        sels = ':'.join(utils.backslash_escape('\\:', 'sel:{}\\'.format(i))
+                        for i in range(n))
+        number = max(1, 10000 // n)
+        for name, s, p in [('selections_desc', descs, libkak.Args.selection_desc),
+                           ('selections', sels, libkak.Args.string)]:
+            assert regex_listof(p)(s) == libkak.Args.listof(p)(s)
+            report('listof {} regex {}'.format(name, n),
+                   per_call(lambda: regex_listof(p)(s), number))
+            report('listof {} scanner {}'.format(name, n),
+                   per_call(lambda: libkak.Args.listof(p)(s), number))
+            report('listof {} lazy {}'.format(name, n),
+                   per_call(lambda: sum(1 for _ in libkak.Args.iterlistof(p)(s)), number))
+
+
+@benchmark
+def dispatch():
+    """
+    Overhead of calling a handler with the arguments it names: looking
+    them up per call (safe_kwcall) vs once (kwcaller), and a whole
+    Remote.handle of a message with a handler that does nothing.
+    """
+    def handler(client, timestamp, buffile, filetype, line, column):
+        pass
+
+    d = dict(client='unnamed0', timestamp=1, buffile='a.py', filetype='python',
+             line=1, column=1, pipe=None)
+    call = utils.kwcaller(handler)
+    report('dispatch safe_kwcall', per_call(lambda: utils.safe_kwcall(handler, d), 10000))
+    report('dispatch kwcaller', per_call(lambda: call(d), 10000))
+
+    r = libkak.Remote(utils.noop)
+    r.ret = utils.noop
+    r(handler)
+    try:
+        line = '_s'.join(str(d[name]) for name in r._argnames())
+        report('dispatch Remote.handle', per_call(lambda: r.handle(line), 10000))
+    finally:
+        libkak._fifo_cleanup()
+
+
+@benchmark
+def did_change():
+    """
+    A one character edit in the middle of a large buffer: the size of the
+    didChange message with the full text vs an incremental change, the
+    time to compute the change, and the time a server needs to decode the
+    message.
+    """
+    import json
+    for n in [100, 10 * 1000, 100 * 1000]:
+        old = ''.join('    line_{} = call(line_{})\n'.format(i, i - 1) for i in range(n))
+        i = len(old) // 2
+        new = old[:i] + 'x' + old[i:]
+        for name, changes in [('full', lambda: [{'text': new}]),
+                              ('incremental', lambda: [utils.text_change(old, new)])]:
+            msg = utils.jsonrpc({
+                'method': 'textDocument/didChange',
+                'params': {
+                    'textDocument': {'uri': 'file:///a.py', 'version': 2},
+                    'contentChanges': changes()
+                }
+            })
+            body = msg.partition(b'\r\n\r\n')[2]
+            report('did_change {} diff {} lines'.format(name, n),
+                   per_call(changes, 10), '{} B sent'.format(len(msg)))
+            report('did_change {} server decode {} lines'.format(name, n),
+                   per_call(lambda: json.loads(body.decode('utf-8')), 10))
+
+
+def old_frames(f):
+    """
+    The header parsing Langserver.spawn used before utils.frames.
+    """
+    contentLength = 0
+    while True:
+        line = f.readline().decode('utf-8').strip()
+        line = utils.drop_prefix(line, 'Header:  ')
+        if line:
+            header, value = line.split(":")
+            if header == "Content-Length":
+                contentLength = int(value)
+        else:
+            content = f.read(contentLength).decode('utf-8')
+            if content == "":
+                return
+            yield content
+
+
+@benchmark
+def frames():
+    """
+    Reading a flood of diagnostics and completion responses from a
+    language server: line by line headers and decoding to a string (old)
+    vs chunked reads into a reused buffer (new), with and without
+    json.loads.
+    """
+    import io
+    import json
+    diagnostics = {
+        'method': 'textDocument/publishDiagnostics',
+        'params': {
+            'uri': 'file:///a.ts',
+            'diagnostics': [{
+                'message': 'line {}'.format(i),
+                'range': {'start': {'line': i, 'character': 0},
+                          'end': {'line': i, 'character': 4}}
+            } for i in range(1000)]
+        }
+    }
+    completion = {
+        'id': 1,
+        'result': {'items': [{'label': 'item_{}'.format(i), 'kind': 6}
+                             for i in range(3000)]}
+    }
+    for n in [10, 100]:
+        data = b''.join(utils.jsonrpc(dict(obj)) for obj in [diagnostics, completion] * n)
+
+        def old(loads=utils.noop):
+            f = io.BufferedReader(io.BytesIO(data))
+            for content in old_frames(f):
+                loads(content)
+
+        def new(loads=utils.noop):
+            f = io.BufferedReader(io.BytesIO(data))
+            for view in utils.frames(f.read1):
+                loads(utils.decode_view(view))
+
+        mb = len(data) / 1e6
+        for name, f in [('old', old), ('new', new)]:
+            for what, loads in [('framing', utils.noop), ('json', json.loads)]:
+                seconds = per_call(lambda: f(loads), 1)
+                report('frames {} {} {:.1f} MB'.format(name, what, mb), seconds,
+                       '{:.0f} MB/s'.format(mb / seconds))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
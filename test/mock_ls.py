@@ -24,6 +24,9 @@ class MockStdio(object):
     >>> print(io.readline().decode('utf-8'))
     c
     <BLANKLINE>
+    >>> io.write('d')
+    >>> print(io.read1(5).decode('utf-8'))
+    d
     >>> io.closed = True
     >>> print(io.readline().decode('utf-8'))
     <BLANKLINE>
@@ -54,6 +57,15 @@ class MockStdio(object):
             cs.append(c)
         return utils.encode(''.join(cs))
 
+    def read1(self, n):
+        cs = [self.read(1)]
+        while cs[0] and len(cs) < n:
+            try:
+                cs.append(utils.encode(self.q.get_nowait()))
+            except:
+                break
+        return b''.join(cs)
+
     def readline(self):
         cs = []
         while True:
@@ -84,10 +96,13 @@ def listen(p):
     return obj
 
 
-def process(mock, result=None):
+def process(mock, result=None, capabilities={}):
     """
     Listen for a message to the mock process and make a standard
     reply or return result if it is not None.
+
+    The reply to initialize has the standard capabilities updated
+    with capabilities.
     """
     obj = listen(mock)
     method = obj['method']
@@ -104,6 +119,7 @@ def process(mock, result=None):
                 }
             }
         }
+        result['capabilities'].update(capabilities)
     elif method in ['textDocument/didOpen', 'textDocument/didChange']:
         result = None
     elif method == 'textDocument/hover':
@@ -185,7 +201,7 @@ def setup_test(f):
         """)
 
         print('listening for initalization...')
-        obj = process(mock)
+        obj = process(mock, capabilities=getattr(f, 'capabilities', {}))
         assert(obj['method'] == 'initialize')
         print('listening for didOpen..')
         obj = process(mock)
@@ -267,6 +283,43 @@ def test_completion(kak, mock, send):
     assert(s == 'test.apa\n')
 
 
+def incremental(f):
+    """
+    Make the mock server ask for incremental didChange.
+    """
+    f.capabilities = {'textDocumentSync': {'openClose': True, 'change': 2}}
+    return f
+
+
+@setup_test
+@incremental
+def test_incremental_sync(kak, mock, send):
+    send('exec itest<esc>')
+    send('lsp-sync')
+    obj = process(mock)
+    pprint(obj)
+    assert(obj['method'] == 'textDocument/didChange')
+    assert(obj['params']['contentChanges'] == [{
+        'range': {
+            'start': {'line': 0, 'character': 0},
+            'end': {'line': 0, 'character': 0}
+        },
+        'text': 'test'
+    }])
+    send('exec ggxyp')
+    send('lsp-sync')
+    obj = process(mock)
+    pprint(obj)
+    assert(obj['method'] == 'textDocument/didChange')
+    assert(obj['params']['contentChanges'] == [{
+        'range': {
+            'start': {'line': 1, 'character': 0},
+            'end': {'line': 1, 'character': 0}
+        },
+        'text': 'test\n'
+    }])
+
+
 @setup_test
 def test_diagnostics(kak, mock, send):
     send('exec 7oabcdefghijklmnopqrstuvwxyz<esc>gg')
@@ -327,4 +380,5 @@ if __name__ == '__main__':
     test_completion(debug)
     test_sighelp(debug)
     test_hover(debug)
+    test_incremental_sync(debug)
     test_diagnostics(debug)
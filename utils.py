@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from threading import Thread
+from __future__ import print_function
+from collections import deque, OrderedDict
+from threading import Thread, Condition, Lock
 import six
 import inspect
 import json
+import logging
+import logging.handlers
+import operator
+import os
+import sys
+import time
+import traceback
+import zlib
 
 
 def drop_prefix(s, prefix):
@@ -35,6 +45,54 @@ def uri_to_file(uri):
         return None
 
 
+def file_to_uri(path):
+    """
+    >>> print(file_to_uri('/home/user/my proj/@types.js'))
+    file:///home/user/my%20proj/%40types.js
+    """
+    return 'file://' + six.moves.urllib.parse.quote(path)
+
+
+def project_root(directory, markers=('.git', 'setup.py', 'package.json'), _cache={}):
+    """
+    The closest directory containing one of markers, starting from
+    directory and going up, or None. Answers are cached per directory.
+
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(tmp, 'proj', '.git'))
+    >>> os.makedirs(os.path.join(tmp, 'proj', 'src', 'lib'))
+    >>> project_root(os.path.join(tmp, 'proj', 'src', 'lib')) == os.path.join(tmp, 'proj')
+    True
+    >>> project_root(os.path.join(tmp, 'proj', 'src')) == os.path.join(tmp, 'proj')
+    True
+    >>> print(project_root('*scratch*'))
+    None
+    >>> import shutil
+    >>> shutil.rmtree(tmp)
+    """
+    if not directory or not os.path.isabs(directory):
+        return None
+    seen = []
+    d = directory
+    while True:
+        if (d, markers) in _cache:
+            root = _cache[d, markers]
+            break
+        seen.append(d)
+        if any(os.path.exists(os.path.join(d, marker)) for marker in markers):
+            root = d
+            break
+        parent = os.path.dirname(d)
+        if parent == d:
+            root = None
+            break
+        d = parent
+    for d in seen:
+        _cache[d, markers] = root
+    return root
+
+
 def range(r):
     y0 = int(r['start']['line']) + 1
     x0 = int(r['start']['character']) + 1
@@ -42,11 +100,241 @@ def range(r):
     x1 = int(r['end']['character'])
     return ((y0, x0), (y1, x1))
 
+
+def utf16_len(s):
+    u"""
+    The length of s in UTF-16 code units, which is what the language
+    server protocol counts characters in.
+
+    >>> utf16_len(u'aå😀')
+    4
+    """
+    return len(s.encode('utf-16-le')) // 2
+
+
+def _common_prefix(a, b, limit, step=1024):
+    """
+    The length of the common prefix of a and b, at most limit.
+
+    Compares blocks of step characters first so that long common
+    prefixes are skipped at the speed of string comparison, and then
+    bisects the block where they differ.
+
+    >>> _common_prefix('abcde', 'abXde', 5, step=2)
+    2
+    """
+    i = 0
+    while i + step <= limit and a[i:i + step] == b[i:i + step]:
+        i += step
+    hi = min(i + step, limit)
+    while i < hi:
+        mid = (i + hi + 1) // 2
+        if a[i:mid] == b[i:mid]:
+            i = mid
+        else:
+            hi = mid - 1
+    return i
+
+
+def _common_suffix(a, b, limit, step=1024):
+    """
+    The length of the common suffix of a and b, at most limit.
+
+    >>> _common_suffix('abcde', 'abXde', 5, step=2)
+    2
+    >>> _common_suffix('aa', 'aaa', 1)
+    1
+    """
+    n, m = len(a), len(b)
+    i = 0
+    while i + step <= limit and a[n - i - step:n - i] == b[m - i - step:m - i]:
+        i += step
+    hi = min(i + step, limit)
+    while i < hi:
+        mid = (i + hi + 1) // 2
+        if a[n - mid:n - i] == b[m - mid:m - i]:
+            i = mid
+        else:
+            hi = mid - 1
+    return i
+
+
+def text_change(old, new):
+    r"""
+    The change of a single range that turns old into new, as a
+    TextDocumentContentChangeEvent, or None if they are equal.
+
+    The range spans what is left between the longest common prefix
+    and suffix.
+
+    >>> import pprint
+    >>> pprint.pprint(text_change('a\nbc\nd\n', 'a\nbXc\nd\n'))
+    {'range': {'end': {'character': 1, 'line': 1},
+               'start': {'character': 1, 'line': 1}},
+     'text': 'X'}
+    >>> pprint.pprint(text_change('a\nb\nc\n', 'a\nc\n'))
+    {'range': {'end': {'character': 0, 'line': 2},
+               'start': {'character': 0, 'line': 1}},
+     'text': ''}
+    >>> pprint.pprint(text_change('\n', 'test.\n'))
+    {'range': {'end': {'character': 0, 'line': 0},
+               'start': {'character': 0, 'line': 0}},
+     'text': 'test.'}
+    >>> pprint.pprint(text_change('a', 'a\nb'))
+    {'range': {'end': {'character': 1, 'line': 0},
+               'start': {'character': 1, 'line': 0}},
+     'text': '\nb'}
+    >>> text_change('a\n', 'a\n') is None
+    True
+    """
+    if old == new:
+        return None
+    m = min(len(old), len(new))
+    prefix = _common_prefix(old, new, m)
+    suffix = _common_suffix(old, new, m - prefix)
+
+    def position(i):
+        line_start = old.rfind('\n', 0, i) + 1
+        return {'line': old.count('\n', 0, i),
+                'character': utf16_len(old[line_start:i])}
+    return {
+        'range': {
+            'start': position(prefix),
+            'end': position(len(old) - suffix)
+        },
+        'text': new[prefix:len(new) - suffix]
+    }
+
+
+def fingerprint(view, chunk=64 * 1024):
+    """
+    A fingerprint of the bytes in view: its length and the crc32 of
+    each chunk of it, so that equal contents can be detected without
+    decoding them, and chunks that differ can be told apart.
+
+    >>> a = fingerprint(memoryview(b'abcdef'), chunk=2)
+    >>> len(a)
+    4
+    >>> a == fingerprint(memoryview(bytearray(b'abcdef')), chunk=2)
+    True
+    >>> [x == y for x, y in zip(a, fingerprint(memoryview(b'abXdef'), chunk=2))]
+    [True, True, False, True]
+    """
+    n = len(view)
+    return (n,) + tuple(zlib.crc32(view[i:i + chunk].tobytes()) & 0xffffffff
+                        for i in six.moves.range(0, n, chunk))
+
+
+def _content_length(headers):
+    r"""
+    The Content-Length among the headers of a message, or 0 if missing.
+
+    >>> _content_length(b'Content-Type: utf-8\r\ncontent-length: 12')
+    12
+    >>> _content_length(b'Header:  Content-Length: 3')
+    3
+    """
+    for line in headers.split(b'\r\n'):
+        # typescript-langserver has this extra Header:
+        if line.startswith(b'Header:'):
+            line = line[len(b'Header:'):]
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            return int(value)
+    return 0
+
+
+def frames(read, size=64 * 1024):
+    r"""
+    The payloads of the Content-Length framed messages read by read.
+
+    read(n) should return between one and n bytes, or nothing at the
+    end of the stream. Bytes are read in chunks of size into a buffer,
+    and the payloads are memoryviews into it. The unread tail is copied
+    into a fresh buffer rather than resized in place, since a buffer
+    cannot be resized while a view of it is alive, and Python 2
+    memoryviews cannot be released.
+
+    >>> import io
+    >>> data = jsonrpc({'id': 1}) + b'Content-Type: x\r\nContent-Length: 2\r\n\r\n{}'
+    >>> for view in frames(io.BytesIO(data).read, size=4):
+    ...     print(json.loads(decode_view(view)).get('id'))
+    1
+    None
+    >>> views = list(frames(io.BytesIO(data).read, size=4))
+    >>> [json.loads(decode_view(view)).get('id') for view in views]
+    [1, None]
+    """
+    buf = bytearray()
+    pos = 0
+    length = None
+    while True:
+        if length is None:
+            end = buf.find(b'\r\n\r\n', pos)
+            if end != -1:
+                length = _content_length(bytes(buf[pos:end]))
+                pos = end + 4
+                continue
+        elif len(buf) - pos >= length:
+            yield memoryview(buf)[pos:pos + length]
+            pos += length
+            length = None
+            continue
+        if pos:
+            buf = buf[pos:]
+            pos = 0
+        chunk = read(max(size, (length or 0) - len(buf)))
+        if not chunk:
+            return
+        buf += chunk
+
+
 def jsonrpc(obj):
+    u"""
+    A Content-Length framed message of obj, as utf-8 bytes.
+
+    >>> header, _, body = jsonrpc({'text': u'å'}).partition(b'\\r\\n\\r\\n')
+    >>> print(decode(header))
+    Content-Length: 32
+    >>> len(body)
+    32
+    """
     obj['jsonrpc'] = '2.0'
-    msg = json.dumps(obj)
-    msg = u"Content-Length: {0}\r\n\r\n{1}".format(len(msg), msg)
-    return msg.encode('utf-8')
+    body = encode(json.dumps(obj, ensure_ascii=False))
+    return encode(u"Content-Length: {0}\r\n\r\n".format(len(body))) + body
+
+
+def writev(f, bufs):
+    """
+    Write all of bufs to the file f, in one system call when the
+    platform has writev and f is backed by a file descriptor.
+    Returns the number of system calls made.
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> writev(f, [b'ab', b'cd'])
+    1
+    >>> print(decode(f.getvalue()))
+    abcd
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        fd = None
+    if fd is None or not hasattr(os, 'writev'):
+        f.write(b''.join(bufs))
+        f.flush()
+        return 1
+    bufs = [memoryview(buf) for buf in bufs]
+    calls = 0
+    while bufs:
+        n = os.writev(fd, bufs)
+        calls += 1
+        while bufs and n >= len(bufs[0]):
+            n -= len(bufs.pop(0))
+        if bufs:
+            bufs[0] = bufs[0][n:]
+    return calls
 
 
 def deindent(s):
@@ -92,6 +380,339 @@ def fork(loop=False):
     return decorate
 
 
+class Pool(object):
+    """
+    A bounded pool of worker threads.
+
+    Jobs are submitted under a key, and at most limit jobs of a key run
+    at the same time. If supersede is true, jobs of the key that are
+    still queued are dropped when a new one is submitted, calling their
+    drop function if they have one. Keys take turns for the workers.
+
+    A job submitted with spare true never waits for jobs of other keys:
+    if no worker is free for it, a spare thread is started, which exits
+    once there is nothing left to do.
+
+    >>> from threading import Event
+    >>> pool = Pool(workers=2)
+    >>> first, go = Event(), Event()
+    >>> pool.submit('a', lambda: (first.set(), go.wait()), limit=1)
+    >>> first.wait()
+    True
+    >>> ran = []
+    >>> for i in [0, 1, 2]:
+    ...     pool.submit('a', lambda i=i: ran.append(i), limit=1, supersede=True,
+    ...                 drop=lambda i=i: print('dropped', i))
+    dropped 0
+    dropped 1
+    >>> pool.stats()['a']['dropped'], pool.stats()['a']['waiting']
+    (2, 1)
+    >>> go.set()
+    >>> pool.join()
+    >>> ran
+    [2]
+    >>> sorted(pool.stats()['a'].items())
+    [('done', 2), ('dropped', 2), ('max_waiting', 1), ('running', 0), ('submitted', 4), ('waiting', 0)]
+
+    >>> pool = Pool(workers=1)
+    >>> first, go = Event(), Event()
+    >>> pool.submit('slow', lambda: (first.set(), go.wait()))
+    >>> first.wait()
+    True
+    >>> done = Event()
+    >>> pool.submit('reply', done.set, spare=True)
+    >>> done.wait(5)
+    True
+    >>> go.set()
+    >>> pool.join()
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.threads = []
+        self.cond = Condition()
+        self.pending = OrderedDict()
+        self.limits = {}
+        self.running = {}
+        self.counts = {}
+        self.idle = 0
+
+    def submit(self, key, job, limit=None, supersede=False, drop=None, spare=False):
+        """
+        Run job in a worker thread.
+        """
+        dropped = []
+        with self.cond:
+            if key not in self.pending:
+                self.pending[key] = deque()
+                self.running[key] = 0
+                self.counts[key] = dict(submitted=0, done=0, dropped=0, max_waiting=0)
+            q = self.pending[key]
+            counts = self.counts[key]
+            if supersede and q:
+                counts['dropped'] += len(q)
+                dropped = list(q)
+                q.clear()
+            q.append((job, drop))
+            self.limits[key] = limit
+            counts['submitted'] += 1
+            counts['max_waiting'] = max(counts['max_waiting'], len(q))
+            if len(self.threads) < self.workers:
+                thread = Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            elif spare and self._runnable() > self.idle:
+                thread = Thread(target=self.work, args=(True,))
+                thread.daemon = True
+                thread.start()
+            self.cond.notify()
+        for _, drop in dropped:
+            if drop:
+                drop()
+
+    def stats(self):
+        """
+        Counts per key, and how many jobs are waiting and running now.
+        """
+        with self.cond:
+            return {key: dict(self.counts[key],
+                              waiting=len(q),
+                              running=self.running[key])
+                    for key, q in six.iteritems(self.pending)}
+
+    def forget(self, key):
+        """
+        Drop the jobs of key still waiting, and its counts unless some
+        of its jobs are running.
+        """
+        with self.cond:
+            if key not in self.pending:
+                return
+            self.pending[key].clear()
+            if not self.running[key]:
+                del self.pending[key]
+                del self.limits[key]
+                del self.running[key]
+                del self.counts[key]
+            self.cond.notify_all()
+
+    def join(self):
+        """
+        Wait until no jobs are waiting or running.
+        """
+        with self.cond:
+            while any(self.pending.values()) or any(self.running.values()):
+                self.cond.wait()
+
+    def _runnable(self):
+        """
+        How many queued jobs could start now.
+        """
+        n = 0
+        for key, q in six.iteritems(self.pending):
+            limit = self.limits[key]
+            if limit is None:
+                n += len(q)
+            else:
+                n += max(0, min(len(q), limit - self.running[key]))
+        return n
+
+    def _next(self):
+        for key, q in six.iteritems(self.pending):
+            limit = self.limits[key]
+            if q and (limit is None or self.running[key] < limit):
+                job, _ = q.popleft()
+                # the key goes last, so that the other keys get the next turns
+                del self.pending[key]
+                self.pending[key] = q
+                return key, job
+        return None, None
+
+    def work(self, spare=False):
+        while True:
+            with self.cond:
+                key, job = self._next()
+                while job is None:
+                    if spare:
+                        return
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                    key, job = self._next()
+                self.running[key] += 1
+            try:
+                job()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                with self.cond:
+                    self.running[key] -= 1
+                    self.counts[key]['done'] += 1
+                    self.cond.notify_all()
+
+
+class LRU(object):
+    """
+    A cache of at most size entries, and at most max_bytes of them in
+    total as measured by sizeof, dropping the least recently used first.
+
+    >>> cache = LRU(size=2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', None)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b', 'missing')
+    'missing'
+    >>> cache.evict(lambda key: key == 'a')
+    >>> sorted(cache.entries)
+    ['c']
+    >>> sorted(cache.stats.items())
+    [('bytes', 1), ('evicted', 2), ('hits', 1), ('misses', 1)]
+    """
+
+    def __init__(self, size=256, max_bytes=None, sizeof=lambda value: len(json.dumps(value))):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0, 'bytes': 0}
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.stats['misses'] += 1
+                return default
+            self.stats['hits'] += 1
+            value, nbytes = self.entries[key] = self.entries.pop(key)
+            return value
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.stats['bytes'] -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.stats['bytes'] += nbytes
+            while self.entries and (len(self.entries) > self.size or
+                                    self.max_bytes is not None and
+                                    self.stats['bytes'] > self.max_bytes):
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.stats['bytes'] -= dropped
+                self.stats['evicted'] += 1
+
+    def evict(self, predicate):
+        """
+        Drop the entries whose key satisfies predicate.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.stats['bytes'] -= self.entries.pop(key)[1]
+                self.stats['evicted'] += 1
+
+
+class Debouncer(object):
+    """
+    Run jobs after a delay, collapsing bursts of them.
+
+    A job scheduled under a key runs delay seconds after the key was last
+    scheduled, but no later than max_wait seconds after it was first
+    scheduled since it last ran. Only the latest job of a key runs.
+    Jobs scheduled with priority run before other jobs that are due, and
+    their deadline is not postponed by jobs without priority.
+
+    >>> from threading import Event
+    >>> ran, done = [], Event()
+    >>> d = Debouncer()
+    >>> for i in [0, 1, 2]:
+    ...     d('a', lambda i=i: (ran.append(i), done.set()), delay=0.2, max_wait=1)
+    >>> d('b', lambda: ran.append('x'), delay=0.05, max_wait=1, priority=True)
+    >>> d('b', lambda: ran.append('b'), delay=1, max_wait=1)
+    >>> done.wait(2)
+    True
+    >>> ran
+    ['b', 2]
+    >>> sorted(d.stats.items())
+    [('collapsed', 3), ('ran', 2), ('scheduled', 5)]
+    >>> d.stop()
+    >>> d.thread.join(1)
+    >>> d.thread.is_alive()
+    False
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.pending = {}
+        self.thread = None
+        self.stopped = False
+        self.stats = {'scheduled': 0, 'collapsed': 0, 'ran': 0}
+
+    def __call__(self, key, job, delay, max_wait, priority=False):
+        """
+        Schedule job to run under key.
+        """
+        now = time.time()
+        with self.cond:
+            if self.stopped:
+                return
+            self.stats['scheduled'] += 1
+            if key in self.pending:
+                self.stats['collapsed'] += 1
+                deadline, first, had_priority, _ = self.pending[key]
+                if not had_priority or priority:
+                    deadline = min(now + delay, first + max_wait)
+                priority = priority or had_priority
+            else:
+                first = now
+                deadline = now + min(delay, max_wait)
+            self.pending[key] = (deadline, first, priority, job)
+            if not self.thread:
+                self.thread = Thread(target=self.work)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def _due(self):
+        now = time.time()
+        due = [(not priority, deadline, key, job)
+               for key, (deadline, _, priority, job) in six.iteritems(self.pending)
+               if deadline <= now]
+        for _, _, key, _ in due:
+            del self.pending[key]
+        return [job for _, _, _, job in sorted(due, key=lambda x: x[:2])]
+
+    def stop(self):
+        """
+        Drop the pending jobs and stop the worker thread.
+        """
+        with self.cond:
+            self.stopped = True
+            self.pending.clear()
+            self.cond.notify()
+
+    def work(self):
+        while True:
+            with self.cond:
+                jobs = self._due()
+                while not jobs:
+                    if self.stopped:
+                        return
+                    if self.pending:
+                        deadline = min(p[0] for p in six.itervalues(self.pending))
+                        self.cond.wait(max(0, deadline - time.time()))
+                    else:
+                        self.cond.wait()
+                    jobs = self._due()
+                self.stats['ran'] += len(jobs)
+            for job in jobs:
+                try:
+                    job()
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
+
 def join(words, sep=u' '):
     """
     Join strings or bytes into a string, returning a string.
@@ -123,6 +744,39 @@ def decode(s):
         raise ValueError('Expected string or bytes')
 
 
+def read_into(f, buf):
+    """
+    Read the unbuffered file f to its end into the bytearray buf,
+    doubling buf when it is full. Returns the number of bytes read.
+
+    >>> import io
+    >>> buf = bytearray(2)
+    >>> n = read_into(io.BytesIO(b'hello'), buf)
+    >>> print(decode_view(memoryview(buf)[:n]), len(buf))
+    hello 8
+    """
+    n = 0
+    while True:
+        if n == len(buf):
+            buf.extend(bytearray(max(len(buf), 1)))
+        k = f.readinto(memoryview(buf)[n:])
+        if not k:
+            return n
+        n += k
+
+
+def decode_view(view):
+    u"""
+    Decode a memoryview of utf-8 bytes into a string.
+
+    >>> print(decode_view(memoryview(u'å'.encode('utf-8'))))
+    å
+    """
+    if six.PY2:
+        return view.tobytes().decode('utf-8')
+    return str(view, 'utf-8')
+
+
 def single_quote_escape(string):
     """
     Backslash-escape ' and \ in Kakoune style .
@@ -153,7 +807,9 @@ def argnames(f):
     >>> argnames(lambda x, y, *zs, **kws: None)
     ['x', 'y']
     """
-    return inspect.getargspec(f).args
+    if six.PY2:
+        return inspect.getargspec(f).args
+    return inspect.getfullargspec(f).args
 
 
 def safe_kwcall(f, d):
@@ -164,6 +820,63 @@ def safe_kwcall(f, d):
     return f(*(d[k] for k in argnames(f)))
 
 
+def kwcaller(f):
+    """
+    Like safe_kwcall, but with the argument names of f looked up once.
+
+    >>> kwcaller(lambda x, y: x - y)(dict(x=5, y=3, z=1))
+    2
+    >>> kwcaller(lambda: 1)(dict(x=5))
+    1
+    """
+    names = argnames(f)
+    if not names:
+        return lambda d: f()
+    if len(names) == 1:
+        name = names[0]
+        return lambda d: f(d[name])
+    get = operator.itemgetter(*names)
+    return lambda d: f(*get(d))
+
+
+class lazy(object):
+    """
+    Formats as f(*args), which is only computed if it is formatted,
+    for log messages that are expensive to make.
+
+    >>> print(lazy(max, 1, 2))
+    2
+    """
+
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+
+    def __str__(self):
+        return str(self.f(*self.args))
+
+    def __unicode__(self):
+        return six.text_type(self.f(*self.args))
+
+
+def setup_logging(level=logging.INFO, filename=None, max_bytes=10 * 1024 * 1024,
+                  backups=3):
+    """
+    Log records of level and above to stderr, or to filename, which is
+    rotated when it grows beyond max_bytes.
+    """
+    if filename:
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backups)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)s %(levelname)s %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+
 def noop(*args, **kwargs):
     """
     Do nothing!